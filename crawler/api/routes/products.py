@@ -21,6 +21,8 @@ def patch_product(product_id: int):
         key, _ = redis.fetch_provisioner("finn.no")
         if key.status == ProvisionerStatus.disabled:
             redis.enable_provisioner("finn.no")
+        else:
+            redis.wake_provisioner("finn.no")
 
     return "OK"
 
@@ -37,3 +39,15 @@ def get_product(product_id):
 def get_sample_products():
     products = prisma.fetch_products_sample(sample_size=10)
     return [p.to_dict() for p in products]
+
+
+@products_bp.route("/products/<product_id>/prices", methods=["GET"])
+@error_handler
+def get_product_prices(product_id):
+    product = prisma.get_product_by_id(int(product_id))
+
+    def gen():
+        for retailer in product.retailers:
+            yield from prisma.fetch_latest_prices(retailer.name, skus=[retailer.sku])
+
+    return [p.to_dict() for p in gen()]
@@ -20,6 +20,8 @@ def provisioner(domain):
     return {
         "key": str(key),
         "value": value.to_dict(),
+        "url_count": redis.count_urls(domain),
+        "failed_url_count": redis.count_failed_urls(domain),
     }
 
 
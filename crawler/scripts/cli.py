@@ -2,10 +2,14 @@ from multiprocessing import Manager, Pool
 import os
 import re
 from string import printable
+from time import perf_counter
 from urllib.parse import urlparse
 import typer
 
-from src.models.url import FailedURLKey
+from src.helpers.import_tools import import_url_canonicalizer
+from src.helpers.misc import timestamp
+from src.models.url import URL, url_ids_key
+from src.models.url_codec import URL_CODECS
 from src.services.redis_service import RedisService
 from src.services.prisma_service import prisma, clear_tables
 from prisma.errors import RawQueryError
@@ -27,11 +31,9 @@ def download_redis(REDIS_URL: str = typer.Option(..., "-f", "--from")):
                 home.set(str(p_key), p_value.to_json())
 
                 for url_key, url_value in other.iter_urls(p_key.domain, p_value.cursor):
-                    home.set(str(url_key), url_value.to_json())
+                    home.set_url(url_key, url_value)
 
-                    if url_value.failed_at:
-                        failed_url_key = FailedURLKey.from_url_key(url_key)
-                        home.set(str(failed_url_key), b"")
+            home.reindex_provisioners()
 
 
 @app.command()
@@ -46,11 +48,97 @@ def upload_redis(REDIS_URL: str = typer.Option(..., "-t", "--to")):
                 other.set(str(p_key), p_value.to_json())
 
                 for url_key, url_value in home.iter_urls(p_key.domain, p_value.cursor):
-                    other.set(str(url_key), url_value.to_json())
+                    other.set_url(url_key, url_value)
 
-                    if url_value.failed_at:
-                        failed_url_key = FailedURLKey.from_url_key(url_key)
-                        other.set(str(failed_url_key), b"")
+            other.reindex_provisioners()
+
+
+@app.command()
+def reindex_redis():
+    with RedisService.from_env_url() as r:
+        r.reindex_provisioners()
+
+        for provisioner_key in r.scan_provisioner_keys():
+            r.reindex_urls(provisioner_key.domain)
+
+
+@app.command()
+def migrate_urls(encoding: str = typer.Option(..., "-t", "--to")):
+    target = URL_CODECS[encoding]
+
+    with RedisService.from_env_url() as r:
+        source = r.url_codec
+
+        if source.name == target.name:
+            print(f'urls are already encoded as "{target.name}"')
+            return
+
+        for provisioner_key in r.scan_provisioner_keys():
+            domain = provisioner_key.domain
+            print(
+                f'migrating urls of "{domain}" from "{source.name}" to "{target.name}"'
+            )
+            r.migrate_urls(domain, source, target)
+
+    print(f"set URL_ENCODING={target.name} before starting the workers again")
+
+
+@app.command()
+def compact_urls():
+    with RedisService.from_env_url() as r:
+        for provisioner_key in r.scan_provisioner_keys():
+            domain = provisioner_key.domain
+            merged = r.compact_urls(domain, import_url_canonicalizer(domain))
+            print(f'merged {merged} duplicate urls of "{domain}"')
+
+
+@app.command()
+def benchmark_url_encoding(count: int = 10000):
+    domain = "benchmark.invalid"
+
+    urls = [
+        URL.from_string(f"https://www.{domain}/category/product-{i}/p-{i}/", domain)
+        for i in range(count)
+    ]
+
+    for url, next_url in zip(urls, urls[1:] + urls[:1]):
+        url.value.next = next_url.key.id
+        url.value.scraped_at = timestamp()
+
+    with RedisService.from_env_url() as r:
+        for codec in URL_CODECS.values():
+            start = perf_counter()
+            raw_values = [codec.encode(url.value) for url in urls]
+            encode_time = perf_counter() - start
+
+            start = perf_counter()
+            for raw_value in raw_values:
+                codec.decode(raw_value)
+            decode_time = perf_counter() - start
+
+            pipe = r.pipeline()
+            for url, raw_value in zip(urls, raw_values):
+                pipe.set(codec.key(url.key), raw_value)
+                pipe.sadd(url_ids_key(domain), codec.encode_id(url.key.id))
+            pipe.execute()
+
+            pipe = r.pipeline()
+            for url in urls:
+                pipe.memory_usage(codec.key(url.key), samples=0)
+            pipe.memory_usage(url_ids_key(domain), samples=0)
+            memory = sum(pipe.execute())
+
+            pipe = r.pipeline()
+            for url in urls:
+                pipe.delete(codec.key(url.key))
+            pipe.delete(url_ids_key(domain))
+            pipe.execute()
+
+            print(
+                f"{codec.name}: {memory / count:.1f} bytes/url, "
+                f"encode {count / encode_time:.0f} urls/s, "
+                f"decode {count / decode_time:.0f} urls/s"
+            )
 
 
 @app.command()
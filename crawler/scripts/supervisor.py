@@ -0,0 +1,105 @@
+from datetime import timedelta
+import multiprocessing
+from multiprocessing import Event
+import os
+import signal
+import sys
+from time import monotonic, sleep
+
+# workers are spawned rather than forked, so each of them connects to
+# postgres and redis on its own instead of sharing the parent's connections
+context = multiprocessing.get_context("spawn")
+
+
+def child(stop_event: Event, memory_limit_mb: float = None):
+    # ctrl+c reaches the whole process group, the supervisor decides when
+    # the workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # workers that don't stop in time are terminated. exiting through python
+    # still runs the handler teardowns, which write the buffered prices
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+
+    from scripts.worker import work
+
+    work(stop_event=stop_event, memory_limit_mb=memory_limit_mb)
+
+
+# keeps a fixed number of worker processes running. workers claim one
+# provisioner after another and only exit when they go over the memory limit
+# or crash, and are then replaced by a new one. workers that exit right after
+# starting are restarted after a delay
+def supervise(
+    processes: int,
+    memory_limit_mb: float = None,
+    restart_delay=timedelta(seconds=10),
+    stop_timeout=timedelta(minutes=1),
+):
+    stop_event = context.Event()
+    stopping = False
+
+    # multiprocessing locks are not safe to take in a signal handler, so the
+    # handler only raises a flag and the loop below sets the event
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    workers: list[multiprocessing.Process | None] = [None] * processes
+    started_at = [0.0] * processes
+    start_at = [0.0] * processes
+
+    while not stopping:
+        for i, worker in enumerate(workers):
+            if worker is not None:
+                if worker.is_alive():
+                    continue
+
+                print(f"worker {worker.pid} exited with code {worker.exitcode}")
+                worker.close()
+                workers[i] = None
+
+                if monotonic() - started_at[i] < restart_delay.total_seconds():
+                    start_at[i] = monotonic() + restart_delay.total_seconds()
+
+            if monotonic() < start_at[i]:
+                continue
+
+            worker = context.Process(
+                target=child,
+                args=(stop_event, memory_limit_mb),
+            )
+            worker.start()
+            print(f"started worker {worker.pid}")
+
+            workers[i] = worker
+            started_at[i] = monotonic()
+
+        sleep(1)
+
+    print("Stopping workers")
+    stop_event.set()
+
+    # workers release their provisioners before the next url. the ones that
+    # are still busy after the timeout are terminated
+    deadline = monotonic() + stop_timeout.total_seconds()
+    for worker in workers:
+        if worker is not None:
+            worker.join(max(deadline - monotonic(), 0))
+
+    for worker in workers:
+        if worker is not None and worker.is_alive():
+            print(f"worker {worker.pid} did not stop in time, terminating")
+            worker.terminate()
+            worker.join()
+
+
+if __name__ == "__main__":
+    memory_limit_mb = os.getenv("WORKER_MEMORY_LIMIT_MB")
+
+    supervise(
+        processes=int(os.getenv("WORKER_PROCESSES", str(os.cpu_count()))),
+        memory_limit_mb=float(memory_limit_mb) if memory_limit_mb else None,
+    )
@@ -1,11 +1,16 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
 from multiprocessing import Event
 import os
+from time import sleep
 import traceback
 import psutil
 
+from src.helpers.exceptions import ExceededMemoryLimit
 from src.services.redis_service import RedisService
-from src.services.web_page_service import WebPageService
+from src.services.web_page_service import ClientPool, WebPageService
 from src.models.url import URL
 from src.services.provisioner import (
     CouldNotFindProvisioner,
@@ -16,27 +21,41 @@ from src.services.provisioner import (
 )
 
 
+def check_memory(memory_limit_mb: float = None):
+    memory_info = psutil.Process(os.getpid()).memory_info()
+    memory_usage_mb = memory_info.rss / 1024**2
+    print("Current memory usage:", memory_usage_mb, "MB")
+
+    if memory_limit_mb and memory_usage_mb > memory_limit_mb:
+        raise ExceededMemoryLimit()
+
+
+# the stop event and the memory limit are checked before a url is handled,
+# which is then still due, so the next claim starts from there
 def default_handler(
     p: Provisioner,
     start_event: Event = None,
     service: WebPageService = None,
+    stop_event: Event = None,
+    memory_limit_mb: float = None,
+    client_pool: ClientPool = None,
 ):
-    with service or WebPageService.from_domain(p.key.domain) as web:
+    with service or WebPageService.from_domain(p.key.domain, client_pool) as web:
         if start_event:
             start_event.set()
 
         # TODO: respect robots.txt
-        for url in p.iter_urls():
-            print("handling url:", url)
-            if url.visited:
-                p.append_pending_urls()
+        for url in p.iter_urls(web.canonicalize):
+            if stop_event and stop_event.is_set():
+                print("Stop requested, releasing provisioner")
+                return
 
-            memory_info = psutil.Process(os.getpid()).memory_info()
-            memory_usage_mb = memory_info.rss / 1024**2
-            print("Current memory usage:", memory_usage_mb, "MB")
+            check_memory(memory_limit_mb)
+
+            print("handling url:", url)
 
             try:
-                new_urls_str = web.handle_url(url.value.url)
+                new_urls_str = web.handle_url(url.value.url, url.value)
                 new_urls = [URL.from_string(u, p.key.domain) for u in new_urls_str]
 
                 p.append_urls(new_urls)
@@ -47,25 +66,225 @@ def default_handler(
                 p.fail_url(url)
 
 
+def concurrent_handler(
+    p: Provisioner,
+    start_event: Event = None,
+    services: list[WebPageService] = None,
+    concurrency=4,
+    request_interval=timedelta(milliseconds=250),
+    stop_event: Event = None,
+    memory_limit_mb: float = None,
+    client_pool: ClientPool = None,
+    executors: list[ThreadPoolExecutor] = None,
+):
+    if not services:
+        services = [
+            WebPageService.from_domain(p.key.domain, client_pool)
+            for _ in range(len(executors) if executors else concurrency)
+        ]
+
+    asyncio.run(
+        crawl_concurrently(
+            p,
+            services,
+            start_event,
+            request_interval,
+            stop_event,
+            memory_limit_mb,
+            executors,
+        )
+    )
+
+
+async def crawl_concurrently(
+    p: Provisioner,
+    services: list[WebPageService],
+    start_event: Event,
+    request_interval: timedelta,
+    stop_event: Event = None,
+    memory_limit_mb: float = None,
+    executors: list[ThreadPoolExecutor] = None,
+):
+    loop = asyncio.get_running_loop()
+
+    # every service gets a thread of its own, since playwright clients can only
+    # be used from the thread that set them up. executors passed in are kept
+    # by the caller, so pooled clients can be reused on the same threads
+    own_executors = not executors
+    if own_executors:
+        executors = [ThreadPoolExecutor(max_workers=1) for _ in services]
+
+    slots = [*zip(executors, services)]
+
+    idle_slots = asyncio.Queue()
+    in_flight: deque[tuple[URL, asyncio.Task]] = deque()
+    next_request_at = loop.time()
+
+    async def fetch(url: URL):
+        nonlocal next_request_at
+
+        executor, web = await idle_slots.get()
+
+        try:
+            request_at = max(next_request_at, loop.time())
+            next_request_at = request_at + request_interval.total_seconds()
+            await asyncio.sleep(request_at - loop.time())
+
+            return await loop.run_in_executor(
+                executor, web.handle_url, url.value.url, url.value
+            )
+        finally:
+            idle_slots.put_nowait((executor, web))
+
+    async def commit_next():
+        url, task = in_flight.popleft()
+
+        try:
+            new_urls_str = await task
+            new_urls = [URL.from_string(u, p.key.domain) for u in new_urls_str]
+
+            p.append_urls(new_urls)
+            p.set_scraped(url)
+        except Exception as e:
+            print("failed for url", url, e, type(e).__name__)
+            print(traceback.format_exc())
+            p.fail_url(url)
+
+    async def commit_all():
+        while in_flight:
+            await commit_next()
+
+    await asyncio.gather(
+        *[loop.run_in_executor(executor, web.__enter__) for executor, web in slots]
+    )
+
+    for slot in slots:
+        idle_slots.put_nowait(slot)
+
+    try:
+        if start_event:
+            start_event.set()
+
+        urls = p.iter_urls(services[0].canonicalize)
+        while True:
+            # urls in flight are still due until they are committed, so they
+            # are committed before more urls are fetched from the frontier, or
+            # they would be fetched twice and written back out of date
+            if not p.window:
+                await commit_all()
+
+            try:
+                url = next(urls)
+            except (ProvisionerTooOld, ExitProvisioner):
+                await commit_all()
+                raise
+
+            if stop_event and stop_event.is_set():
+                print("Stop requested, releasing provisioner")
+                await commit_all()
+                return
+
+            try:
+                check_memory(memory_limit_mb)
+            except ExceededMemoryLimit:
+                await commit_all()
+                raise
+
+            print("handling url:", url)
+
+            while len(in_flight) >= 2 * len(slots):
+                await commit_next()
+
+            in_flight.append((url, asyncio.create_task(fetch(url))))
+
+            await asyncio.sleep(0)
+            while in_flight and in_flight[0][1].done():
+                await commit_next()
+
+    finally:
+        await asyncio.gather(*[task for _, task in in_flight], return_exceptions=True)
+
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(executor, web.__exit__, None, None, None)
+                for executor, web in slots
+            ]
+        )
+
+        if own_executors:
+            for executor, _ in slots:
+                executor.shutdown()
+
+
 def run(
     handler=default_handler,
     *args,
     timeout=timedelta(minutes=5),
     max_age=timedelta(minutes=10),
+    prefetch=20,
     **kwargs,
 ):
-    with Provisioner(timeout=timeout, max_age=max_age) as p:
+    with Provisioner(timeout=timeout, max_age=max_age, prefetch=prefetch) as p:
         handler(p, *args, **kwargs)
 
 
-if __name__ == "__main__":
+# claims provisioners one after another until stopped. clients and their
+# threads are kept between claims, so browsers are launched once per process.
+# going over the memory limit ends the loop, since only a new process gives
+# the memory back
+def work(
+    stop_event: Event = None,
+    memory_limit_mb: float = None,
+    claim_interval=timedelta(seconds=10),
+):
+    concurrency = int(os.getenv("WORKER_CONCURRENCY", "1"))
+
+    client_pool = ClientPool()
+    executors = []
+    if concurrency > 1:
+        executors = [ThreadPoolExecutor(max_workers=1) for _ in range(concurrency)]
+
+    def stopped():
+        return stop_event is not None and stop_event.is_set()
+
     try:
-        run()
-    except ProvisionerTooOld:
-        print("Provisioner too old, exiting")
-    except CouldNotFindProvisioner:
-        print("Could not find provisioner, exiting")
-    except TakeOver:
-        print("Someone else is handling this provisioner, exiting")
-    except ExitProvisioner as e:
-        print("Exiting:", e)
+        while not stopped():
+            try:
+                if concurrency > 1:
+                    run(
+                        concurrent_handler,
+                        stop_event=stop_event,
+                        memory_limit_mb=memory_limit_mb,
+                        client_pool=client_pool,
+                        executors=executors,
+                    )
+                else:
+                    run(
+                        stop_event=stop_event,
+                        memory_limit_mb=memory_limit_mb,
+                        client_pool=client_pool,
+                    )
+            except ProvisionerTooOld:
+                print("Provisioner too old, claiming the next one")
+            except CouldNotFindProvisioner:
+                print("Could not find provisioner, waiting")
+                if stop_event:
+                    stop_event.wait(claim_interval.total_seconds())
+                else:
+                    sleep(claim_interval.total_seconds())
+            except TakeOver:
+                print("Someone else is handling this provisioner, claiming another")
+            except ExitProvisioner as e:
+                print("Exiting provisioner:", e)
+    except ExceededMemoryLimit:
+        print("Exceeded memory limit, exiting")
+    finally:
+        for executor in executors:
+            executor.submit(client_pool.close).result()
+            executor.shutdown()
+
+        client_pool.close()
+
+
+if __name__ == "__main__":
+    work()
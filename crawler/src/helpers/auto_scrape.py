@@ -1,9 +1,12 @@
 from dataclasses import dataclass
+from functools import cached_property
 from html import unescape
+from html.parser import HTMLParser
 import json
+import os
 from pprint import pprint
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, UnicodeDammit
 import microdata
 
 
@@ -12,38 +15,45 @@ class ParseJsonLdException(Exception):
     error: Exception
 
 
+METATAG_NAME_ATTRIBUTES = ["name", "property", "itemprop", "http-equiv"]
+
+
+def add_metatag(metatags_data: dict, attrs: dict):
+    name_key = next(
+        (attr for attr in attrs if attr in METATAG_NAME_ATTRIBUTES),
+        None,
+    )
+    if name_key is not None:
+        name = attrs[name_key]
+        value = attrs.get("content")
+
+        if name not in metatags_data:
+            metatags_data[name] = []
+
+        metatags_data[name].append(value)
+
+
 def parse_metatags_data(soup: BeautifulSoup):
     metatags_data = {}
     meta_tags = soup.find_all("meta")
 
     for elem in meta_tags:
-        name_key = next(
-            (
-                attr
-                for attr in elem.attrs
-                if attr in ["name", "property", "itemprop", "http-equiv"]
-            ),
-            None,
-        )
-        if name_key is not None:
-            name = elem.attrs[name_key]
-            value = elem.get("content")
-
-            if name not in metatags_data:
-                metatags_data[name] = []
-
-            metatags_data[name].append(value)
+        add_metatag(metatags_data, elem.attrs)
 
     return metatags_data
 
 
 def get_jsonld_data(soup: BeautifulSoup):
+    scripts = soup.find_all("script", {"type": "application/ld+json"})
+    return parse_jsonld_scripts([script.string for script in scripts])
+
+
+def parse_jsonld_scripts(scripts: list[str]):
     jsonld_data = {}
 
-    scripts = soup.find_all("script", {"type": "application/ld+json"})
     for script in scripts:
         try:
-            parsed_json = json.loads(unescape(script.string))
+            parsed_json = json.loads(unescape(script))
             if not isinstance(parsed_json, list):
                 parsed_json = [parsed_json]
             for obj in parsed_json:
@@ -56,12 +66,108 @@ def get_jsonld_data(soup: BeautifulSoup):
     return jsonld_data
 
 
-def parse(content):
-    soup = BeautifulSoup(content, "html.parser")
+# collects meta tags, JSON-LD scripts and anchor hrefs in a single pass over
+# the markup without building a tree
+class StreamingExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.metatags: dict[str, list[str]] = {}
+        self.jsonld_scripts: list[str] = []
+        self.links: list[str] = []
+        self.script: list[str] = None
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str]]):
+        if tag == "a":
+            href = dict(attrs).get("href")
+            if href is not None:
+                self.links.append(href)
+        elif tag == "meta":
+            add_metatag(self.metatags, dict(attrs))
+        elif tag == "script":
+            if dict(attrs).get("type") == "application/ld+json":
+                self.script = []
+
+    def handle_data(self, data: str):
+        if self.script is not None:
+            self.script.append(data)
+
+    def handle_endtag(self, tag: str):
+        if tag == "script" and self.script is not None:
+            self.jsonld_scripts.append("".join(self.script))
+            self.script = None
+
+
+# features a scraper can ask for. "dom" builds the full tree and every other
+# representation is then read from it, otherwise jsonld, metatags and links
+# come from one streaming pass and the tree is only built if soup is used
+FEATURES = {"jsonld", "metatags", "links", "microdata", "dom"}
+
+
+# a page parsed once and shared by the scraper and the link extraction. every
+# representation is built the first time it is used. the parser is any tree
+# builder beautifulsoup supports, e.g. "lxml" when lxml is installed
+class Document:
+    def __init__(
+        self,
+        content: bytes | str,
+        parser: str = None,
+        features: set[str] = None,
+    ):
+        self.content = content
+        self.parser = parser or os.getenv("HTML_PARSER", "html.parser")
+        self.features = features or set()
+        assert self.features <= FEATURES
+
+    @property
+    def dom(self) -> bool:
+        return "dom" in self.features
+
+    @cached_property
+    def text(self) -> str:
+        if isinstance(self.content, str):
+            return self.content
+        return UnicodeDammit(self.content, is_html=True).unicode_markup
+
+    @cached_property
+    def soup(self) -> BeautifulSoup:
+        return BeautifulSoup(self.content, self.parser)
+
+    @cached_property
+    def extracted(self) -> StreamingExtractor:
+        extractor = StreamingExtractor()
+        extractor.feed(self.text)
+        extractor.close()
+        return extractor
+
+    @cached_property
+    def metatags(self) -> dict:
+        if self.dom:
+            return parse_metatags_data(self.soup)
+        return self.extracted.metatags
+
+    @cached_property
+    def jsonld(self) -> dict:
+        if self.dom:
+            return get_jsonld_data(self.soup)
+        return parse_jsonld_scripts(self.extracted.jsonld_scripts)
+
+    @cached_property
+    def links(self) -> list[str]:
+        if self.dom:
+            return [a["href"] for a in self.soup.find_all("a", href=True)]
+        return self.extracted.links
+
+    @cached_property
+    def microdata(self) -> list:
+        return microdata.get_items(self.content)
+
+
+def parse(content: bytes | str | Document):
+    document = content if isinstance(content, Document) else Document(content)
     return {
-        "metatags": parse_metatags_data(soup),
-        "microdata": microdata.get_items(content),
-        "jsonld": get_jsonld_data(soup),
+        "metatags": document.metatags,
+        "microdata": document.microdata,
+        "jsonld": document.jsonld,
     }
 
 
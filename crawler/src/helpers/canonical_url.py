@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from fnmatch import fnmatchcase
+from urllib.parse import unquote_plus, urlsplit, urlunsplit
+
+# query parameters that only tell the site where a visitor came from
+TRACKING_PARAMS = frozenset(
+    {"utm_*", "fbclid", "gclid", "dclid", "msclkid", "mc_cid", "mc_eid", "_ga"}
+)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def strip_www(host: str) -> str:
+    return host.removeprefix("www.")
+
+
+# rewrites the variants of a url that lead to the same page to one form, so
+# they hash to the same url id. scrapers can configure it for their domain
+# with a module level URL_CANONICALIZER. parameter lists take shell-style
+# patterns. allowed_params of None allows every parameter that is not denied.
+# trailing_slash of None leaves paths as they are, True adds a slash and False
+# removes it. links to the bare or www host of a site are moved to host, or to
+# the host of the page they were found on
+@dataclass(frozen=True)
+class URLCanonicalizer:
+    allowed_params: frozenset[str] | None = None
+    denied_params: frozenset[str] = TRACKING_PARAMS
+    strip_fragment: bool = True
+    sort_params: bool = True
+    trailing_slash: bool | None = False
+    host: str | None = None
+
+    def keeps_param(self, name: str) -> bool:
+        if any(fnmatchcase(name, pattern) for pattern in self.denied_params):
+            return False
+
+        if self.allowed_params is None:
+            return True
+
+        return any(fnmatchcase(name, pattern) for pattern in self.allowed_params)
+
+    def canonical_path(self, path: str) -> str:
+        if self.trailing_slash is None:
+            return path
+
+        # the last segment of a file path like /feed.xml keeps its form
+        if "." in path.rsplit("/", 1)[-1]:
+            return path
+
+        path = path.rstrip("/")
+        if self.trailing_slash:
+            return path + "/"
+
+        return path
+
+    def __call__(self, url: str, page_host: str = None) -> str:
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            return url
+
+        if parts.scheme not in DEFAULT_PORTS:
+            return url
+
+        host = (parts.hostname or "").lower()
+        preferred_host = self.host or page_host
+        if preferred_host and strip_www(host) == strip_www(preferred_host):
+            host = preferred_host.lower()
+
+        if port and port != DEFAULT_PORTS[parts.scheme]:
+            host = f"{host}:{port}"
+
+        # parameters are matched and sorted by their decoded form, but keep the
+        # quoting they were found with, since sites may read %20 and + apart
+        params = [
+            param
+            for param in parts.query.split("&")
+            if param and self.keeps_param(unquote_plus(param.split("=", 1)[0]))
+        ]
+        if self.sort_params:
+            params.sort(
+                key=lambda param: [unquote_plus(p) for p in param.split("=", 1)]
+            )
+
+        return urlunsplit(
+            (
+                parts.scheme.lower(),
+                host,
+                self.canonical_path(parts.path),
+                "&".join(params),
+                "" if self.strip_fragment else parts.fragment,
+            )
+        )
+
+
+DEFAULT_CANONICALIZER = URLCanonicalizer()
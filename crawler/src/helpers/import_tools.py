@@ -1,7 +1,10 @@
+from dataclasses import dataclass
 import importlib
 from pathlib import Path
 from typing import Callable
 
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
+
 
 def import_module(function_path: str):
     src_dir = Path(__file__).parent.parent
@@ -15,11 +18,34 @@ def import_module(function_path: str):
     return module
 
 
-def import_scraper(domain: str) -> Callable:
+# what the scraper module of a domain provides. scrapers list the Document
+# features they use in a module level FEATURES set, and scrapers that don't are
+# given the full tree. they can set how the urls of their domain are
+# canonicalized with a module level URL_CANONICALIZER
+@dataclass(frozen=True)
+class ScraperModule:
+    scrape: Callable | None
+    features: set[str]
+    canonicalize: URLCanonicalizer
+
+
+# runs the scraper module of the domain once and reads everything from it
+def import_scraper_module(domain: str) -> ScraperModule:
     try:
         module = import_module(f"scrapers/{domain}.py")
-
-        function = getattr(module, "scrape")
-        return function
     except FileNotFoundError:
-        return None
+        return ScraperModule(
+            scrape=None,
+            features=set(),
+            canonicalize=DEFAULT_CANONICALIZER,
+        )
+
+    return ScraperModule(
+        scrape=getattr(module, "scrape"),
+        features=getattr(module, "FEATURES", {"dom"}),
+        canonicalize=getattr(module, "URL_CANONICALIZER", DEFAULT_CANONICALIZER),
+    )
+
+
+def import_url_canonicalizer(domain: str) -> URLCanonicalizer:
+    return import_scraper_module(domain).canonicalize
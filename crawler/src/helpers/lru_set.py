@@ -0,0 +1,30 @@
+from collections import OrderedDict
+from typing import Hashable, Iterable
+
+
+# set that forgets the least recently used items past max_size
+class LRUSet:
+    def __init__(self, max_size=10_000):
+        self.max_size = max_size
+        self.items: OrderedDict[Hashable, None] = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, item: Hashable) -> bool:
+        if item not in self.items:
+            return False
+
+        self.items.move_to_end(item)
+        return True
+
+    def add(self, items: Iterable[Hashable]):
+        for item in items:
+            self.items[item] = None
+            self.items.move_to_end(item)
+
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
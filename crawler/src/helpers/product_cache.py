@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from dataclasses import replace
+from datetime import timedelta
+from threading import Lock
+from time import monotonic
+
+from src.models.product import Product
+
+
+def cache_keys(product: Product) -> list[tuple]:
+    return [
+        *(("gtin", gtin) for gtin in product.gtins),
+        *(("mpn", mpn) for mpn in product.mpns),
+        *(("retailer", r.name, r.sku) for r in product.retailers),
+    ]
+
+
+# remembers recently upserted products under each of their identifiers. a
+# retailer sku belongs to at most one product and identifiers are never
+# removed, so a cached product that owns the sku and already has the gtin
+# and mpn is what find_existing_product would return, with nothing to update
+class ProductCache:
+    def __init__(self, max_size=10_000, ttl=timedelta(hours=1)):
+        self.max_size = max_size
+        self.ttl = ttl.total_seconds()
+        self.entries: OrderedDict[tuple, tuple[float, Product]] = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return f"hits={self.hits} misses={self.misses} size={len(self.entries)}"
+
+    def get(self, key: tuple) -> Product | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, product = entry
+        if expires_at < monotonic():
+            self.entries.pop(key, None)
+            return None
+
+        self.entries.move_to_end(key)
+        return product
+
+    def lookup(self, retailer_name: str, sku: str, gtin: str = None, mpn: str = None):
+        keys = [("retailer", retailer_name, sku), ("gtin", gtin), ("mpn", mpn)]
+
+        with self.lock:
+            for key in keys:
+                product = self.get(key)
+                if product is None:
+                    continue
+
+                retailer_ids = [(r.name, r.sku) for r in product.retailers]
+                if (
+                    (retailer_name, sku) in retailer_ids
+                    and gtin in product.gtins
+                    and mpn in product.mpns
+                ):
+                    self.hits += 1
+                    return product
+
+            self.misses += 1
+            return None
+
+    def put(self, product: Product):
+        assert product.id is not None
+        expires_at = monotonic() + self.ttl
+
+        product = replace(
+            product,
+            gtins=[*product.gtins],
+            mpns=[*product.mpns],
+            retailers=[*product.retailers],
+        )
+
+        with self.lock:
+            for key in cache_keys(product):
+                self.entries[key] = (expires_at, product)
+                self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, product: Product):
+        with self.lock:
+            for key in cache_keys(product):
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
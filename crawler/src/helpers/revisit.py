@@ -0,0 +1,45 @@
+from datetime import timedelta
+import os
+
+from src.models.url import URLValue
+
+# pages without products only lead to other pages and rarely change what
+# they link to. they are the urls that never recorded a change. product pages
+# and finn searches start at the min interval, which grows by the
+# backoff factor with every visit that finds them unchanged, up to the max
+# interval, and drops back to the min once they change
+PAGE_REVISIT_INTERVAL = timedelta(hours=float(os.getenv("PAGE_REVISIT_HOURS", "72")))
+MIN_PRODUCT_REVISIT_INTERVAL = timedelta(
+    hours=float(os.getenv("MIN_PRODUCT_REVISIT_HOURS", "1"))
+)
+MAX_PRODUCT_REVISIT_INTERVAL = timedelta(
+    hours=float(os.getenv("MAX_PRODUCT_REVISIT_HOURS", "24"))
+)
+REVISIT_BACKOFF = float(os.getenv("REVISIT_BACKOFF", "2"))
+MAX_BACKOFF = MAX_PRODUCT_REVISIT_INTERVAL / MIN_PRODUCT_REVISIT_INTERVAL
+FAILED_REVISIT_INTERVAL = timedelta(hours=float(os.getenv("FAILED_REVISIT_HOURS", "6")))
+
+
+def revisit_interval(value: URLValue) -> timedelta:
+    if value.fingerprint is None and value.changed_at is None:
+        return PAGE_REVISIT_INTERVAL
+
+    # the exponent is capped too, so pages that were unchanged for a long
+    # time don't overflow the float
+    backoff = min(REVISIT_BACKOFF ** min(value.unchanged_visits, 64), MAX_BACKOFF)
+
+    return MIN_PRODUCT_REVISIT_INTERVAL * backoff
+
+
+# called after every visit that got an answer from the page, so the interval
+# follows how often the page was seen changing
+def record_visit(value: URLValue, changed: bool, now: int):
+    if changed:
+        value.changed_at = now
+        value.unchanged_visits = 0
+    else:
+        value.unchanged_visits += 1
+
+
+def next_due(value: URLValue, now: int) -> int:
+    return now + round(revisit_interval(value) / timedelta(milliseconds=1))
@@ -0,0 +1,18 @@
+from dataclasses import dataclass
+
+from dataclasses_json import dataclass_json
+
+
+@dataclass_json
+@dataclass(order=True, frozen=True)
+class PriceObservation(object):
+    retailer: str
+    sku: str
+    price: float
+    observed_at: int
+
+    def __post_init__(self):
+        assert isinstance(self.retailer, str)
+        assert isinstance(self.sku, str)
+        assert isinstance(self.price, (int, float))
+        assert isinstance(self.observed_at, int)
@@ -12,12 +12,22 @@ class URLValue(object):
     next: str
     scraped_at: int | None = None
     failed_at: int | None = None
+    fingerprint: str | None = None
+    etag: str | None = None
+    last_modified: str | None = None
+    changed_at: int | None = None
+    unchanged_visits: int = 0
 
     def __post_init__(self):
         assert isinstance(self.url, str)
         assert isinstance(self.next, str)
         assert isinstance(self.scraped_at, (int, NoneType))
         assert isinstance(self.failed_at, (int, NoneType))
+        assert isinstance(self.fingerprint, (str, NoneType))
+        assert isinstance(self.etag, (str, NoneType))
+        assert isinstance(self.last_modified, (str, NoneType))
+        assert isinstance(self.changed_at, (int, NoneType))
+        assert isinstance(self.unchanged_visits, int)
 
 
 @dataclass(order=True, frozen=True)
@@ -69,6 +79,20 @@ class FailedURLKey(object):
         return f"failed_url:{self.domain}:{self.id}"
 
 
+def url_ids_key(domain: str) -> str:
+    return f"urls:{domain}"
+
+
+def failed_url_ids_key(domain: str) -> str:
+    return f"failed_urls:{domain}"
+
+
+# sorted set of the ids of every url of a domain, scored by when the url is
+# due to be crawled again as a millisecond timestamp
+def frontier_key(domain: str) -> str:
+    return f"frontier:{domain}"
+
+
 @dataclass(order=True, frozen=True)
 class URL(object):
     value: URLValue
@@ -0,0 +1,91 @@
+from abc import ABC, abstractmethod
+from dataclasses import fields
+import json
+import os
+import struct
+
+from src.models.url import URLKey, URLValue
+
+
+class URLCodec(ABC):
+    name: str
+
+    @abstractmethod
+    def encode_id(self, url_id: str) -> bytes:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def decode_id(self, raw: bytes) -> str:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def encode(self, value: URLValue) -> bytes:
+        raise NotImplementedError()
+
+    @abstractmethod
+    def decode(self, raw: bytes) -> URLValue:
+        raise NotImplementedError()
+
+    def key_prefix(self, domain: str) -> bytes:
+        return f"url:{domain}:".encode()
+
+    def key(self, key: URLKey) -> bytes:
+        return self.key_prefix(key.domain) + self.encode_id(key.id)
+
+
+class JSONURLCodec(URLCodec):
+    name = "json"
+
+    def encode_id(self, url_id: str) -> bytes:
+        return url_id.encode()
+
+    def decode_id(self, raw: bytes) -> str:
+        return raw.decode()
+
+    def encode(self, value: URLValue) -> bytes:
+        return value.to_json().encode()
+
+    def decode(self, raw: bytes) -> URLValue:
+        return URLValue.from_json(raw)
+
+
+# stores url ids as 16 raw bytes instead of 32 hex characters. values are a
+# version byte and the binary id of the next url, followed by the remaining
+# URLValue fields as a JSON array in field order. the next id is at a fixed
+# offset so Lua scripts can follow the ring without decoding the value
+class PackedURLCodec(URLCodec):
+    name = "packed"
+    version = 1
+    header = struct.Struct("<B16s")
+    payload_fields = [f.name for f in fields(URLValue) if f.name != "next"]
+
+    def encode_id(self, url_id: str) -> bytes:
+        return bytes.fromhex(url_id)
+
+    def decode_id(self, raw: bytes) -> str:
+        return raw.hex()
+
+    def encode(self, value: URLValue) -> bytes:
+        header = self.header.pack(self.version, self.encode_id(value.next))
+        payload = [getattr(value, name) for name in self.payload_fields]
+        return header + json.dumps(payload, separators=(",", ":")).encode()
+
+    def decode(self, raw: bytes) -> URLValue:
+        version, next_id = self.header.unpack_from(raw)
+        assert version == self.version
+
+        payload = json.loads(raw[self.header.size :])
+
+        return URLValue(
+            next=self.decode_id(next_id),
+            **dict(zip(self.payload_fields, payload)),
+        )
+
+
+URL_CODECS: dict[str, URLCodec] = {
+    codec.name: codec for codec in [JSONURLCodec(), PackedURLCodec()]
+}
+
+
+def url_codec_from_env() -> URLCodec:
+    return URL_CODECS[os.getenv("URL_ENCODING", JSONURLCodec.name)]
@@ -0,0 +1,101 @@
+from math import ceil, log
+import os
+from uuid import uuid4
+
+from redis import Redis
+
+
+def url_filter_key(domain: str) -> str:
+    return f"url_filter:{domain}"
+
+
+# the size and number of hashes the bits of the filter were set with, and a
+# token that is new every time the filter starts over or is rebuilt
+def url_filter_params_key(domain: str) -> str:
+    return f"url_filter_params:{domain}"
+
+
+# bloom filter of the ids of the urls of a domain. the bits live in a redis
+# bitmap, with redis' bit order, and are mirrored in memory while the domain is
+# claimed. the size and number of hashes are stored next to the bits, so
+# changing the capacity or error rate starts a new filter instead of
+# misreading the old one
+class URLFilter:
+    def __init__(self, domain: str, capacity: int, error_rate: float):
+        assert capacity > 0
+        assert 0 < error_rate < 1
+
+        self.domain = domain
+        self.capacity = capacity
+        self.size = ceil(-capacity * log(error_rate) / log(2) ** 2)
+        self.hashes = max(round(-log(error_rate, 2)), 1)
+        self.bits = bytearray(ceil(self.size / 8))
+        self.stamp: str = None
+
+    @property
+    def key(self) -> str:
+        return url_filter_key(self.domain)
+
+    @property
+    def params(self) -> str:
+        return f"{self.size}:{self.hashes}"
+
+    @classmethod
+    def from_env(cls, domain: str):
+        return cls(
+            domain,
+            capacity=int(os.getenv("URL_FILTER_CAPACITY", "1000000")),
+            error_rate=float(os.getenv("URL_FILTER_ERROR_RATE", "0.0001")),
+        )
+
+    # the bits are only read when the stamp in redis is not the one they were
+    # loaded with. bits other workers set since are then missing in memory,
+    # which only sends those urls to redis, where they are found and added
+    def load(self, r: Redis):
+        stamp = r.get(url_filter_params_key(self.domain))
+        stamp = stamp.decode() if stamp else None
+
+        if stamp and stamp == self.stamp:
+            return
+
+        if stamp is None or ":".join(stamp.split(":")[:2]) != self.params:
+            print(f"url filter of {self.domain} has other parameters, starting over")
+            self.bits = bytearray(len(self.bits))
+            self.stamp = f"{self.params}:{uuid4().hex}"
+
+            pipe = r.pipeline()
+            pipe.delete(self.key)
+            pipe.set(url_filter_params_key(self.domain), self.stamp)
+            pipe.execute()
+            return
+
+        raw = r.get(self.key) or b""
+        self.bits = bytearray(len(self.bits))
+        self.bits[: len(raw)] = raw[: len(self.bits)]
+        self.stamp = stamp
+
+    def save(self, r: Redis):
+        self.stamp = f"{self.params}:{uuid4().hex}"
+        r.set(self.key, bytes(self.bits))
+        r.set(url_filter_params_key(self.domain), self.stamp)
+
+    # url ids are hex sha256 prefixes, so their two halves serve as the
+    # independent hashes for double hashing
+    def positions(self, url_id: str) -> list[int]:
+        h1 = int(url_id[:16], 16)
+        h2 = int(url_id[16:], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, url_id: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (0x80 >> (position & 7))
+            for position in self.positions(url_id)
+        )
+
+    # sets the bits in memory, and in redis when given a pipeline
+    def add(self, url_ids: list[str], pipe: Redis = None):
+        for url_id in url_ids:
+            for position in self.positions(url_id):
+                self.bits[position >> 3] |= 0x80 >> (position & 7)
+                if pipe is not None:
+                    pipe.setbit(self.key, position, 1)
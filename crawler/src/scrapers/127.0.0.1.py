@@ -1,11 +1,12 @@
 from src.models.product import Product, Retailer
 from src.helpers.exceptions import NotAProductPage
-import src.helpers.auto_scrape as auto_scraper
+from src.helpers.auto_scrape import Document
 
+FEATURES = {"jsonld"}
 
-def scrape(url: str, content):
-    auto_scraped = auto_scraper.parse(content)
-    product_jsons = auto_scraped.get("jsonld", {}).get("Product", None)
+
+def scrape(url: str, document: Document):
+    product_jsons = document.jsonld.get("Product", None)
 
     if not product_jsons:
         raise NotAProductPage()
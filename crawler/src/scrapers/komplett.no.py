@@ -1,10 +1,12 @@
 from pprint import pprint
-from bs4 import BeautifulSoup
 import requests
 
 from src.helpers.exceptions import CouldNotScrape, NotAProductPage
 from src.models.product import Product, Retailer
-import src.helpers.auto_scrape as auto_scraper
+from src.helpers.auto_scrape import Document
+
+# komplett reads the spec table and brand from the tree
+FEATURES = {"jsonld", "dom"}
 
 
 def _nested_attribute(o, attribute_names: list):
@@ -35,8 +37,8 @@ def _nested_attribute(o, attribute_names: list):
     )
 
 
-def _find_element(soup: BeautifulSoup, finder: dict) -> str:
-    tags = soup.find_all(finder["tag"])
+def _find_element(element, finder: dict) -> str:
+    tags = element.find_all(finder["tag"])
     for tag in tags:
         if "where" in finder:
             child_tag, child_tag_text = finder["where"]
@@ -50,9 +52,9 @@ def _find_element(soup: BeautifulSoup, finder: dict) -> str:
         return tag.text
 
 
-def _find_ean(soup: BeautifulSoup) -> str:
+def _find_ean(document: Document) -> str:
     return _find_element(
-        soup,
+        document.soup,
         {
             "tag": "table",
             "where": ("caption.text", "Generelt"),
@@ -67,8 +69,8 @@ def _find_ean(soup: BeautifulSoup) -> str:
     )
 
 
-def _find_brand(soup: BeautifulSoup) -> str:
-    brand_element = soup.find(itemprop="manufacturer")
+def _find_brand(document: Document) -> str:
+    brand_element = document.soup.find(itemprop="manufacturer")
     if brand_element:
         return brand_element.text
 
@@ -88,9 +90,8 @@ def _find_category(url_path: str, sku: str) -> str:
     return category
 
 
-def scrape(url: str, content):
-    auto_scraped = auto_scraper.parse(content)
-    product_jsons = auto_scraped.get("jsonld", {}).get("Product", None)
+def scrape(url: str, document: Document):
+    product_jsons = document.jsonld.get("Product", None)
 
     if not product_jsons:
         raise NotAProductPage()
@@ -101,13 +102,11 @@ def scrape(url: str, content):
     price_str = product_json["offers"]["price"]
     price = float(price_str)
 
-    soup = BeautifulSoup(content, "html.parser")
-
     yield Product(
         name=product_json["name"],
-        brand=_find_brand(soup),
+        brand=_find_brand(document),
         description=product_json["description"],
-        gtins=[_find_ean(soup)],
+        gtins=[_find_ean(document)],
         image=product_json["image"],
         mpns=[product_json["mpn"]],
         retailers=[
@@ -131,4 +130,4 @@ if __name__ == "__main__":
         },
     )
 
-    pprint(scrape(response))
+    pprint([*scrape(response.url, Document(response.content, features=FEATURES))])
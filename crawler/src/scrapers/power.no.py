@@ -4,21 +4,26 @@ from src.services.web_page_service import (
     ClientTester,
     PlayWrightClient,
 )
-import src.helpers.auto_scrape as auto_scraper
+from src.helpers.auto_scrape import Document
+from src.helpers.canonical_url import URLCanonicalizer
 from src.helpers.exceptions import NotAProductPage
 from src.models.product import Product, Retailer
 
+FEATURES = {"jsonld"}
 
-def scrape(url: str, content):
-    auto_scraped = auto_scraper.parse(content)
-    product_jsons = auto_scraped.get("jsonld", {}).get("Product", None)
+# power's own links end in a slash, and the bare host redirects to www
+URL_CANONICALIZER = URLCanonicalizer(trailing_slash=True, host="www.power.no")
+
+
+def scrape(url: str, document: Document):
+    product_jsons = document.jsonld.get("Product", None)
 
     if not product_jsons:
         raise NotAProductPage()
 
     product_json = product_jsons[0]
 
-    breadcrumb_list = auto_scraped["jsonld"]["BreadcrumbList"]
+    breadcrumb_list = document.jsonld["BreadcrumbList"]
     breadcrumbs = [b["name"] for b in breadcrumb_list[0]["itemListElement"]]
     category = "/".join(breadcrumbs[:-1])
 
@@ -50,4 +55,4 @@ if __name__ == "__main__":
 
     with ClientTester(PlayWrightClient()) as web:
         content = web.get(url)
-        pprint([*scrape(url, content)])
+        pprint([*scrape(url, Document(content, features=FEATURES))])
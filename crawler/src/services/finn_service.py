@@ -1,13 +1,19 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
+from math import ceil
 import requests
+import requests.adapters
 
 from src.services.prisma_service import (
     get_product_by_id,
-    upsert_finn_ads,
+    reconcile_finn_ads,
 )
 from src.models.finn_ad import FinnAd, RawFinnAd
 from src.services.url_handler import URLHandler
+from src.models.url import URLValue
 from src.models.product import Product
+from src.helpers.misc import timestamp
+from src.helpers.revisit import record_visit
 
 
 class NoFinnAds(Exception):
@@ -20,54 +26,91 @@ def load_json(filename):
 
 
 class FinnURLHandler(URLHandler):
-    def handle_url(self, url: str) -> list[str]:
+    def __init__(self, max_pages=20, concurrency=4):
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+
+    # the stored ads are replaced by the search results, which updates changed
+    # ads and removes sold ones
+    def handle_url(self, url: str, value: URLValue = None) -> list[str]:
         if not url:
             return []
 
         product_id = int(url)
         product = get_product_by_id(product_id)
 
-        raw_finn_ads = self.fetch_finn_ads(product)
+        raw_finn_ads, complete = self.fetch_finn_ads(product)
+        finn_ads = [FinnAd.from_raw(ad, product_id) for ad in raw_finn_ads]
+
+        if not complete:
+            print("finn search was cut short, keeping ads that were not fetched")
+
+        inserted, updated, deleted = reconcile_finn_ads(
+            product_id, finn_ads, complete=complete
+        )
+        print(f"finn ads: {inserted} new, {updated} changed, {deleted} removed")
 
-        if not raw_finn_ads:
+        if value:
+            changed = bool(inserted or updated or deleted)
+            record_visit(value, changed, now=timestamp())
+
+        if not finn_ads:
             raise NoFinnAds()
 
-        finn_ads = [FinnAd.from_raw(ad, product_id) for ad in raw_finn_ads]
-        upsert_finn_ads(finn_ads)
         return []
 
     def setup(self):
-        pass
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.concurrency)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
 
     def teardown(self):
-        pass
-
-    def fetch_finn_ads(self, product: Product) -> list[RawFinnAd]:
+        self.executor.shutdown()
+        self.session.close()
+
+    def fetch_search_page(self, query: str, page: int) -> dict:
+        response = self.session.get(
+            f"https://www.finn.no/api/search-qf?searchkey=SEARCH_ID_BAP_COMMON&q={query}&sort=RELEVANCE&vertical=bap&page={page}",
+        )
+
+        return response.json()
+
+    # the number of pages is only known once the first page is in, the rest
+    # are then fetched concurrently and read in page order. the search is
+    # complete when every page was read, the page cap or an empty page before
+    # the last one leave it incomplete, and the ads past that point are then
+    # unknown rather than gone
+    def fetch_finn_ads(self, product: Product) -> tuple[list[RawFinnAd], bool]:
         assert product.finn_query
 
         query = product.finn_query.replace(" ", "+")
 
-        def gen():
-            match_count = None
-            yielded_count = 0
-            page = 0
-
-            while match_count is None or yielded_count < match_count:
-                page += 1
-
-                response = requests.get(
-                    f"https://www.finn.no/api/search-qf?searchkey=SEARCH_ID_BAP_COMMON&q={query}&sort=RELEVANCE&vertical=bap&page={page}",
-                )
-
-                res_json = response.json()
-
-                match_count = res_json["metadata"]["result_size"]["match_count"]
-
-                ads = res_json["docs"]
-                yielded_count += len(ads)
-                for ad in ads:
-                    yield ad
-
-        return [
-            RawFinnAd.from_dict(ad) for ad in gen() if ad["trade_type"] == "Til salgs"
+        first_page = self.fetch_search_page(query, 1)
+        pages = [first_page["docs"]]
+
+        match_count = first_page["metadata"]["result_size"]["match_count"]
+        page_size = len(first_page["docs"])
+        if page_size:
+            total_pages = ceil(match_count / page_size)
+            page_count = min(total_pages, self.max_pages)
+            complete = page_count == total_pages
+
+            for res_json in self.executor.map(
+                lambda page: self.fetch_search_page(query, page),
+                range(2, page_count + 1),
+            ):
+                if not res_json["docs"]:
+                    complete = False
+                    break
+                pages.append(res_json["docs"])
+        else:
+            complete = not match_count
+
+        raw_finn_ads = [
+            RawFinnAd.from_dict(ad)
+            for ads in pages
+            for ad in ads
+            if ad["trade_type"] == "Til salgs"
         ]
+        return raw_finn_ads, complete
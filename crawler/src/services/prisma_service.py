@@ -1,10 +1,12 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from math import floor
 import os
 from random import random
 from typing import Iterable
 from prisma import Prisma
+from src.helpers.product_cache import ProductCache
 from src.models.finn_ad import FinnAd
+from src.models.price_observation import PriceObservation
 from src.models.product import Category, Product, Retailer
 from prisma.models import Product as PrismaProduct
 
@@ -12,6 +14,8 @@ prisma = Prisma()
 
 prisma.connect()
 
+product_cache = ProductCache()
+
 
 @dataclass
 class AmbiguousProductMatch(Exception):
@@ -42,8 +46,12 @@ def fetch_products_sample(sample_size: int):
     return [as_product_model(p) for p in prisma_products]
 
 
-def insert_product(product: Product, ambiguous_to_id: int | None = None):
-    result = prisma.product.create(
+def insert_product(
+    product: Product,
+    ambiguous_to_id: int | None = None,
+    client: Prisma = prisma,
+):
+    result = client.product.create(
         data={
             "name": product.name,
             "description": product.description,
@@ -232,34 +240,52 @@ def find_existing_product(
         },
     )
 
-    if not prisma_products:
+    return select_existing_product(
+        [as_product_model(p) for p in prisma_products],
+        retailer_name=retailer_name,
+        sku=sku,
+        gtin=gtin,
+        mpn=mpn,
+    )
+
+
+# picks the product a scraped product should be merged into among the
+# products sharing at least one of its identifiers
+def select_existing_product(
+    products: list[Product],
+    retailer_name: str,
+    sku: str,
+    gtin: str = None,
+    mpn: str = None,
+):
+    if not products:
         return None
 
-    prisma_product = prisma_products[0]
+    existing = products[0]
 
-    for product in prisma_products:
+    for product in products:
         retailer_ids = [(r.name, r.sku) for r in product.retailers]
         if (retailer_name, sku) in retailer_ids:
-            if gtin not in [g.gtin for g in product.gtins]:
+            if gtin not in product.gtins:
                 raise IdentifierChangeError()
-            if mpn not in [m.mpn for m in product.mpns]:
+            if mpn not in product.mpns:
                 raise IdentifierChangeError()
-            prisma_product = product
+            existing = product
             break
 
     else:
-        for product in prisma_products:
-            if gtin in [g.gtin for g in product.gtins]:
-                prisma_product = product
+        for product in products:
+            if gtin in product.gtins:
+                existing = product
                 break
 
-    if gtin not in [gtin.gtin for gtin in prisma_product.gtins]:
-        raise AmbiguousProductMatch(prisma_product.id)
+    if gtin not in existing.gtins:
+        raise AmbiguousProductMatch(existing.id)
 
-    return as_product_model(prisma_product)
+    return existing
 
 
-def upsert_product(product: Product):
+def identifiers(product: Product):
     if product.gtins:
         assert len(product.gtins) == 1
 
@@ -274,24 +300,10 @@ def upsert_product(product: Product):
     retailer_name = product.retailers[0].name if product.retailers else None
     sku = product.retailers[0].sku if product.retailers else None
 
-    try:
-        existing = find_existing_product(
-            gtin=gtin,
-            mpn=mpn,
-            retailer_name=retailer_name,
-            sku=sku,
-        )
-
-        if not existing:
-            return insert_product(product)
-    except AmbiguousProductMatch as e:
-        prisma_product = prisma.product.find_unique(
-            where={"id": e.conflicting_product_id},
-        )
+    return gtin, mpn, retailer_name, sku
 
-        root_id = prisma_product.ambiguous_to_id or prisma_product.id
-        return insert_product(product, ambiguous_to_id=root_id)
 
+def add_identifiers(existing: Product, product: Product, client: Prisma = prisma):
     existing_retailer_ids = [r.id for r in existing.retailers]
     retailers_to_add = [
         r for r in product.retailers if r.id not in existing_retailer_ids
@@ -302,7 +314,7 @@ def upsert_product(product: Product):
     mpns_to_add = [mpn for mpn in product.mpns if mpn not in existing.mpns]
 
     if retailers_to_add or gtins_to_add or mpns_to_add:
-        prisma.product.update(
+        client.product.update(
             where={"id": existing.id},
             data={
                 "gtins": {
@@ -326,10 +338,180 @@ def upsert_product(product: Product):
             },
         )
 
+    existing.gtins.extend(gtins_to_add)
+    existing.mpns.extend(mpns_to_add)
+    existing.retailers.extend(retailers_to_add)
+
+
+def upsert_product(product: Product):
+    gtin, mpn, retailer_name, sku = identifiers(product)
+
+    cached = product_cache.lookup(retailer_name, sku, gtin=gtin, mpn=mpn)
+    if cached:
+        return cached.id
+
+    try:
+        existing = find_existing_product(
+            gtin=gtin,
+            mpn=mpn,
+            retailer_name=retailer_name,
+            sku=sku,
+        )
+
+        if not existing:
+            product_id = insert_product(product)
+            product_cache.put(replace(product, id=product_id))
+            return product_id
+    except AmbiguousProductMatch as e:
+        prisma_product = prisma.product.find_unique(
+            where={"id": e.conflicting_product_id},
+        )
+
+        root_id = prisma_product.ambiguous_to_id or prisma_product.id
+        product_id = insert_product(product, ambiguous_to_id=root_id)
+        product_cache.put(replace(product, id=product_id))
+        return product_id
+    except IdentifierChangeError:
+        product_cache.invalidate(product)
+        raise
+
+    add_identifiers(existing, product)
+    product_cache.put(existing)
+
     product_id: int = existing.id
     return product_id
 
 
+# fetches every product sharing a gtin, mpn or retailer sku with any product
+# in the batch in a single query
+def find_matching_products(products: list[Product]) -> list[PrismaProduct]:
+    gtins = list({gtin for p in products for gtin in p.gtins})
+    mpns = list({mpn for p in products for mpn in p.mpns})
+    retailer_ids = {(r.name, r.sku) for p in products for r in p.retailers}
+
+    def gen():
+        if gtins:
+            yield {"gtins": {"some": {"gtin": {"in": gtins}}}}
+
+        if mpns:
+            yield {"mpns": {"some": {"mpn": {"in": mpns}}}}
+
+        if retailer_ids:
+            yield {
+                "retailers": {
+                    "some": {
+                        "OR": [
+                            {"name": name, "sku": sku} for name, sku in retailer_ids
+                        ],
+                    }
+                }
+            }
+
+    where = [*gen()]
+    if not where:
+        return []
+
+    return prisma.product.find_many(
+        where={"OR": where},
+        include={
+            "gtins": True,
+            "mpns": True,
+            "retailers": True,
+        },
+        order={"id": "asc"},
+    )
+
+
+# upserts a batch of products with one lookup query and a single transaction
+# for the writes. matching follows upsert_product, including against products
+# inserted earlier in the same batch. if any product raises, nothing is written
+def upsert_products(products: list[Product]) -> list[int]:
+    cached_ids = {}
+    for i, product in enumerate(products):
+        gtin, mpn, retailer_name, sku = identifiers(product)
+        cached = product_cache.lookup(retailer_name, sku, gtin=gtin, mpn=mpn)
+        if cached:
+            cached_ids[i] = cached.id
+
+    uncached = [p for i, p in enumerate(products) if i not in cached_ids]
+    if not uncached:
+        return [cached_ids[i] for i in range(len(products))]
+
+    prisma_products = find_matching_products(uncached)
+
+    candidates = [as_product_model(p) for p in prisma_products]
+    root_ids = {p.id: p.ambiguous_to_id or p.id for p in prisma_products}
+
+    def matches(candidate: Product, gtin, mpn, retailer_name, sku):
+        return (
+            gtin in candidate.gtins
+            or mpn in candidate.mpns
+            or (retailer_name, sku) in [(r.name, r.sku) for r in candidate.retailers]
+        )
+
+    product_ids = []
+    written: dict[int, Product] = {}
+
+    with prisma.tx() as transaction:
+        for i, product in enumerate(products):
+            if i in cached_ids:
+                product_ids.append(cached_ids[i])
+                continue
+
+            gtin, mpn, retailer_name, sku = identifiers(product)
+            assert retailer_name and sku
+            assert gtin or mpn
+
+            ambiguous_to_id = None
+            try:
+                existing = select_existing_product(
+                    [
+                        c
+                        for c in candidates
+                        if matches(c, gtin, mpn, retailer_name, sku)
+                    ],
+                    gtin=gtin,
+                    mpn=mpn,
+                    retailer_name=retailer_name,
+                    sku=sku,
+                )
+            except AmbiguousProductMatch as e:
+                existing = None
+                ambiguous_to_id = root_ids[e.conflicting_product_id]
+            except IdentifierChangeError:
+                product_cache.invalidate(product)
+                raise
+
+            if existing:
+                add_identifiers(existing, product, client=transaction)
+                written[existing.id] = existing
+                product_ids.append(existing.id)
+                continue
+
+            product_id = insert_product(
+                product,
+                ambiguous_to_id=ambiguous_to_id,
+                client=transaction,
+            )
+
+            inserted = replace(
+                product,
+                id=product_id,
+                gtins=[*product.gtins],
+                mpns=[*product.mpns],
+                retailers=[*product.retailers],
+            )
+            candidates.append(inserted)
+            written[product_id] = inserted
+            root_ids[product_id] = ambiguous_to_id or product_id
+            product_ids.append(product_id)
+
+    for product in written.values():
+        product_cache.put(product)
+
+    return product_ids
+
+
 def get_ambiguous_products(product_id: int):
     prisma_product = prisma.product.find_unique(
         where={"id": product_id},
@@ -409,6 +591,7 @@ def count_pending_urls(domain: str) -> int:
     )
 
 
+# returns the number of ads that were new
 def upsert_finn_ads(finn_ads: list[FinnAd]):
     prisma.finnad.create_many(
         [
@@ -428,6 +611,225 @@ def upsert_finn_ads(finn_ads: list[FinnAd]):
     )
 
 
+# keeps LatestPrice in step with PriceObservation. a row is only replaced by a
+# newer observation, so batches may be written in any order
+UPSERT_LATEST_PRICES_SQL = """
+INSERT INTO "LatestPrice" (retailer, sku, price, observed_at)
+VALUES {values}
+ON CONFLICT (retailer, sku) DO UPDATE
+SET price = EXCLUDED.price, observed_at = EXCLUDED.observed_at
+WHERE "LatestPrice".observed_at < EXCLUDED.observed_at
+"""
+
+
+def insert_price_observations(
+    observations: list[PriceObservation],
+    batch_size=1000,
+):
+    if not observations:
+        return
+
+    latest: dict[tuple[str, str], PriceObservation] = {}
+    for o in observations:
+        key = (o.retailer, o.sku)
+        if key not in latest or latest[key].observed_at < o.observed_at:
+            latest[key] = o
+
+    latest_prices = [*latest.values()]
+
+    with prisma.tx() as transaction:
+        transaction.priceobservation.create_many(
+            [
+                {
+                    "retailer": o.retailer,
+                    "sku": o.sku,
+                    "price": float(o.price),
+                    "observed_at": o.observed_at,
+                }
+                for o in observations
+            ]
+        )
+
+        # postgres allows at most 32767 parameters per statement
+        for i in range(0, len(latest_prices), batch_size):
+            batch = latest_prices[i : i + batch_size]
+
+            values = ", ".join(
+                f"(${j * 4 + 1}, ${j * 4 + 2}, ${j * 4 + 3}::float8, ${j * 4 + 4}::bigint)"
+                for j in range(len(batch))
+            )
+            args = [
+                arg
+                for o in batch
+                for arg in (o.retailer, o.sku, float(o.price), o.observed_at)
+            ]
+
+            transaction.execute_raw(
+                UPSERT_LATEST_PRICES_SQL.format(values=values), *args
+            )
+
+
+def fetch_latest_prices(retailer: str = None, skus: list[str] = None):
+    where = {}
+    if retailer:
+        where["retailer"] = retailer
+    if skus is not None:
+        where["sku"] = {"in": skus}
+
+    prisma_prices = prisma.latestprice.find_many(where=where)
+
+    return [
+        PriceObservation(
+            retailer=p.retailer,
+            sku=p.sku,
+            price=p.price,
+            observed_at=p.observed_at,
+        )
+        for p in prisma_prices
+    ]
+
+
+def fetch_price_history(retailer: str, sku: str, since: int = None, limit=1000):
+    where = {"retailer": retailer, "sku": sku}
+    if since is not None:
+        where["observed_at"] = {"gte": since}
+
+    prisma_prices = prisma.priceobservation.find_many(
+        where=where,
+        order={"observed_at": "desc"},
+        take=limit,
+    )
+
+    return [
+        PriceObservation(
+            retailer=p.retailer,
+            sku=p.sku,
+            price=p.price,
+            observed_at=p.observed_at,
+        )
+        for p in prisma_prices
+    ]
+
+
+# collects price observations from the crawl and writes them in batches. the
+# observations are kept until they are written, and a failed write raises, so
+# the url that filled the batch fails and the batch is written with the next
+class PriceObservationBuffer:
+    def __init__(self, batch_size: int = None):
+        self.batch_size = batch_size or int(os.getenv("PRICE_BATCH_SIZE", "100"))
+        self.observations: list[PriceObservation] = []
+
+    def add(self, products: Iterable[Product], observed_at: int):
+        self.observations.extend(
+            PriceObservation(
+                retailer=r.name,
+                sku=r.sku,
+                price=float(r.price),
+                observed_at=observed_at,
+            )
+            for product in products
+            for r in product.retailers
+        )
+
+        if len(self.observations) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        insert_price_observations(self.observations)
+        self.observations = []
+
+
+FINN_AD_FIELDS = ["lat", "lng", "price", "timestamp", "title", "image"]
+
+UPDATE_FINN_ADS_SQL = """
+UPDATE "FinnAd" AS a
+SET "lat" = v."lat", "lng" = v."lng", "price" = v."price",
+    "timestamp" = v."timestamp", "title" = v."title", "image" = v."image"
+FROM (VALUES {values}) AS v("id", "lat", "lng", "price", "timestamp", "title", "image")
+WHERE a."id" = v."id"
+"""
+
+
+# brings the stored ads of a product in line with a fresh search. only new,
+# changed and vanished ads are written, in a single transaction. relevance is
+# set by hand and kept for ads that are still listed. ads are only removed
+# when the search was complete, since an ad missing from a partial search may
+# just be on a page that was not fetched
+def reconcile_finn_ads(
+    product_id: int,
+    finn_ads: list[FinnAd],
+    complete=True,
+    batch_size=1000,
+):
+    fetched = {ad.id: ad for ad in finn_ads}
+    existing = {ad.id: ad for ad in fetch_finn_ads(product_id)}
+
+    def changed(ad: FinnAd):
+        old = existing[ad.id]
+        return any(getattr(ad, f) != getattr(old, f) for f in FINN_AD_FIELDS)
+
+    to_insert = [ad for id, ad in fetched.items() if id not in existing]
+    to_update = [ad for id, ad in fetched.items() if id in existing and changed(ad)]
+    to_delete = [id for id in existing if id not in fetched] if complete else []
+
+    # an ad id already stored under another product is skipped by create_many,
+    # so only the rows it wrote count as new
+    inserted = 0
+    with prisma.tx() as transaction:
+        if to_insert:
+            inserted = transaction.finnad.create_many(
+                [
+                    {
+                        "id": ad.id,
+                        "image": ad.image,
+                        "lat": ad.lat,
+                        "lng": ad.lng,
+                        "price": ad.price,
+                        "timestamp": ad.timestamp,
+                        "title": ad.title,
+                        "product_id": product_id,
+                    }
+                    for ad in to_insert
+                ],
+                skip_duplicates=True,
+            )
+
+        for i in range(0, len(to_update), batch_size):
+            batch = to_update[i : i + batch_size]
+
+            values = ", ".join(
+                f"(${j * 7 + 1}::int, ${j * 7 + 2}::float8, ${j * 7 + 3}::float8, "
+                f"${j * 7 + 4}::float8, ${j * 7 + 5}::bigint, ${j * 7 + 6}::text, "
+                f"${j * 7 + 7}::text)"
+                for j in range(len(batch))
+            )
+            args = [
+                arg
+                for ad in batch
+                for arg in (
+                    ad.id,
+                    float(ad.lat),
+                    float(ad.lng),
+                    float(ad.price),
+                    ad.timestamp,
+                    ad.title,
+                    ad.image,
+                )
+            ]
+
+            transaction.execute_raw(UPDATE_FINN_ADS_SQL.format(values=values), *args)
+
+        if to_delete:
+            transaction.finnad.delete_many(
+                where={
+                    "id": {"in": to_delete},
+                    "product_id": product_id,
+                },
+            )
+
+    return inserted, len(to_update), len(to_delete)
+
+
 def fetch_finn_ads(product_id: int):
     prisma_finn_ads = prisma.finnad.find_many(where={"product_id": product_id})
     return [
@@ -505,6 +907,9 @@ def clear_tables():
             raise Exception("Aborted")
 
     prisma.product.delete_many()
+    prisma.priceobservation.delete_many()
+    prisma.latestprice.delete_many()
+    product_cache.clear()
 
 
 def count_products():
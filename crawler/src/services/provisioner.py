@@ -1,5 +1,6 @@
+from collections import deque
 from dataclasses import dataclass
-import json
+from itertools import islice
 from datetime import datetime, timedelta
 from math import floor
 import os
@@ -8,13 +9,23 @@ from urllib.parse import urlparse
 from uuid import uuid4
 
 from src.services.prisma_service import delete_pending_urls, fetch_pending_urls
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
+from src.helpers.lru_set import LRUSet
 from src.helpers.misc import timestamp
+from src.helpers.revisit import FAILED_REVISIT_INTERVAL, next_due
 from src.models.provisioner import (
     ProvisionerKey,
     ProvisionerStatus,
     ProvisionerValue,
 )
-from src.models.url import URL, FailedURLKey, URLKey, URLValue
+from src.models.url_filter import URLFilter
+from src.models.url import (
+    URL,
+    URLKey,
+    failed_url_ids_key,
+    frontier_key,
+    url_ids_key,
+)
 from src.services.redis_service import RedisService
 
 
@@ -43,11 +54,28 @@ class ExitProvisioner(Exception):
     reason: str
 
 
+# the url filters of the domains this process has claimed, so a filter is only
+# read from redis again when it was started over or rebuilt
+url_filters: dict[str, URLFilter] = {}
+
+
 class Provisioner:
-    def __init__(self, timeout=timedelta(minutes=5), max_age=timedelta(minutes=10)):
+    def __init__(
+        self,
+        timeout=timedelta(minutes=5),
+        max_age=timedelta(minutes=10),
+        prefetch=20,
+        known_urls_size=10_000,
+    ):
         self.timeout = timeout
         self.max_age = max_age
+        self.prefetch = prefetch
+        self.window: deque[URL] = deque()
+        # ids of urls of the claimed domain that are known to be in the ring,
+        # mostly the links every page has in its header and footer
+        self.known_urls = LRUSet(max_size=known_urls_size)
         self.r = RedisService.from_env_url()
+        self.codec = self.r.url_codec
         self.id = uuid4().hex
         self.disabled = False
         self.take_over = None
@@ -60,6 +88,7 @@ class Provisioner:
         self.key, self.value = self.find_provisioner()
         print(f"claimed provisioner {self}")
         self.cursor = self.fetch_url(self.value.cursor)
+        self.url_filter = self.load_url_filter()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
@@ -68,23 +97,17 @@ class Provisioner:
         if self.take_over:
             raise self.take_over
 
-        pipe = self.r.pipeline()
-
-        value = self.r.get(str(self.key))
-
-        if not value:
-            self.r.quit()
-            raise AlreadyClosed()
-
         new_key = self.key.with_status(
             ProvisionerStatus.disabled if self.disabled else ProvisionerStatus.off
         )
-        pipe.set(str(new_key), value)
-        pipe.delete(str(self.key))
 
-        _, del_count = pipe.execute()
+        # with nothing left to crawl, the provisioner is not claimed again
+        # until its next url is due
+        due_at = None
+        if exc_type is ExitProvisioner:
+            due_at = self.r.next_due(self.key.domain)
 
-        if del_count == 0:
+        if not self.r.move_provisioner(self.key, new_key, due_at=due_at):
             self.r.quit()
             raise AlreadyClosed()
 
@@ -123,71 +146,55 @@ class Provisioner:
             priority=old_key.priority,
         )
 
+    def lease_expiry(self):
+        return timestamp() + round(self.timeout / timedelta(milliseconds=1))
+
     def find_provisioner(self):
         print("finding provisioner...")
 
-        def gen_keys():
-            for i in range(5):
-                yield from self.r.scan_iter(f"provisioner:off:*:{i}")
-
-            max_id = floor(timedelta(days=1) / self.timeout)
-
-            for i in range(2, max_id):
-                time_id = self.time_id(datetime.now() - i * self.timeout)
-
-                for j in range(5):
-                    yield from self.r.scan_iter(f"provisioner:on:{time_id}:*:{j}")
+        claimed = self.r.claim_provisioner(
+            provisioner_id=self.id,
+            time_id=self.time_id(),
+            lease_expiry=self.lease_expiry(),
+        )
 
-        for provisioner_key in gen_keys():
-            try:
-                key = provisioner_key.decode()
-                print(f"attempting to claim provisioner with key {key}")
-                return self.claim_provisioner(key)
-            except AlreadyClaimed as e:
-                print(type(e), e)
-                continue
+        if not claimed:
+            raise CouldNotFindProvisioner()
 
-        raise CouldNotFindProvisioner()
+        return claimed
 
     def claim_provisioner(
         self, key_str: str
     ) -> Tuple[ProvisionerKey, ProvisionerValue]:
-        pipe = self.r.pipeline()
+        print(f"attempting to claim provisioner with key {key_str}")
 
-        provisioner = self.r.get(key_str)
+        claimed = self.r.claim_provisioner(
+            provisioner_id=self.id,
+            time_id=self.time_id(),
+            lease_expiry=self.lease_expiry(),
+            key=ProvisionerKey.from_string(key_str),
+        )
 
-        if not provisioner:
+        if not claimed:
             raise AlreadyClaimed(
-                "Could not find provisioner. Key was probably modified by another worker"
+                "Provisioner is not claimable. It was probably claimed by another worker"
             )
 
-        provisioner_json = json.loads(provisioner)
-
-        value: ProvisionerValue = ProvisionerValue.from_dict(provisioner_json)
-
-        if value.last_scraped:
-            age = timestamp() - value.last_scraped
-            age_timedelta = timedelta(milliseconds=age)
-            print(f"claiming provisioner with age {age_timedelta}")
-
-            old = age_timedelta < self.timeout
+        return claimed
 
-            if "on" in key_str.split(":") and old:
-                raise AlreadyClaimed(f"Last scraped was only {age_timedelta} ago")
+    # a filter past its capacity would take too many new urls for known ones,
+    # so those domains are checked against redis only
+    def load_url_filter(self) -> URLFilter | None:
+        if self.key.domain not in url_filters:
+            url_filters[self.key.domain] = URLFilter.from_env(self.key.domain)
+        url_filter = url_filters[self.key.domain]
 
-        new_key = self.update_key(key_str)
-        pipe.set(str(new_key), provisioner)
-        pipe.delete(key_str)
-
-        _, del_count = pipe.execute()
-
-        if del_count == 0:
-            self.r.delete(str(new_key))
-            raise AlreadyClaimed(
-                "Could not modify key. Key was probably modified by another worker"
-            )
+        if self.r.count_urls(self.key.domain) > url_filter.capacity:
+            print(f"url filter of {self.key.domain} is full, not using it")
+            return None
 
-        return new_key, value
+        url_filter.load(self.r)
+        return url_filter
 
     def fetch_urls(self, url_ids: list[str] = None, should_raise=True) -> list[URL]:
         assert not self.disabled
@@ -203,13 +210,13 @@ class Provisioner:
         ]
 
         for url_key in url_keys:
-            pipe.get(str(url_key))
+            pipe.get(self.codec.key(url_key))
 
-        url_value_jsons = pipe.execute()
+        raw_url_values = pipe.execute()
 
         urls = []
-        for url_key, url_value_json in zip(url_keys, url_value_jsons):
-            if not url_value_json:
+        for url_key, raw_url_value in zip(url_keys, raw_url_values):
+            if not raw_url_value:
                 if should_raise:
                     raise ValueError(f'URL with id "{url_key}" does not exist')
 
@@ -219,7 +226,7 @@ class Provisioner:
             urls.append(
                 URL(
                     key=url_key,
-                    value=URLValue.from_json(url_value_json),
+                    value=self.codec.decode(raw_url_value),
                 )
             )
 
@@ -228,58 +235,96 @@ class Provisioner:
     def fetch_url(self, url_id: str, should_raise=True) -> URL:
         return self.fetch_urls([url_id], should_raise=should_raise)[0]
 
-    def move_cursor(self) -> ProvisionerValue:
-        self.cursor = self.fetch_url(self.cursor.value.next)
-        self.value.cursor = self.cursor.value.next
-        self.value.last_scraped = timestamp()
+    # the urls that are due the soonest, up to the prefetch size. urls stay
+    # in the frontier until they are scraped or failed and rescheduled, so
+    # urls that were never handled are fetched again on the next claim. ids
+    # whose url is gone are removed from the frontier, and reading goes on
+    # until live urls are found or nothing more is due
+    def fetch_due_urls(self) -> list[URL]:
+        while True:
+            raw_ids = self.r.zrangebyscore(
+                frontier_key(self.key.domain),
+                "-inf",
+                timestamp(),
+                start=0,
+                num=max(self.prefetch, 1),
+            )
+
+            if not raw_ids:
+                return []
+
+            urls = self.fetch_urls(
+                [self.codec.decode_id(raw_id) for raw_id in raw_ids],
+                should_raise=False,
+            )
 
-    def iter_urls(self):
+            missing = [raw_id for raw_id, url in zip(raw_ids, urls) if not url]
+            if missing:
+                print(f"removing {len(missing)} missing urls from the frontier")
+                self.r.zrem(frontier_key(self.key.domain), *missing)
+
+            if len(missing) < len(raw_ids):
+                return [url for url in urls if url]
+
+    # pending urls are canonicalized the way the domain's links are, so they
+    # hash to the same url ids
+    def iter_urls(self, canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER):
         assert not self.disabled
         while True:
             if self.age > self.max_age:
                 raise ProvisionerTooOld()
 
+            if not self.window:
+                self.window.extend(self.fetch_due_urls())
+
+            if not self.window:
+                if self.append_pending_urls(canonicalize):
+                    continue
+
+                raise ExitProvisioner("No urls are due.")
+
+            self.cursor = self.window.popleft()
+            self.value.cursor = self.cursor.key.id
+            self.value.last_scraped = timestamp()
+
             yield self.cursor
 
             assert not self.disabled
 
-            self.move_cursor()
-
-            pipe = self.r.pipeline()
-            pipe.delete(str(self.key))
+            old_key = self.key
             self.key = self.update_key()
-            pipe.set(
-                str(self.key),
-                self.value.to_json(),
-            )
 
-            result = pipe.execute()
+            if not self.r.move_provisioner(
+                old_key,
+                self.key,
+                self.value,
+                lease_expiry=self.lease_expiry(),
+            ):
+                # another worker may change the ring from here on
+                self.known_urls.clear()
 
-            del_count = result[0]
-            if del_count == 0:
-                self.r.delete(str(self.key))
                 self.take_over = TakeOver(
                     "Could not modify key. Provisioner was probably claimed by another worker or disabled"
                 )
 
                 raise self.take_over
 
+    # walks the ring of every url of the domain, in the order they were found
     def all_urls(self):
-        start_id = self.cursor.key.id
-        for url in self.iter_urls():
-            yield url
-            if url.value.next == start_id:
-                break
-
-    def all_failed_urls(self):
-        for key in self.r.scan_iter(f"failed_url:{self.key.domain}:*"):
-            url_id = key.decode().split(":")[-1]
-            url_key = URLKey(domain=self.key.domain, id=url_id)
-            url_value = URLValue.from_json(self.r.get(str(url_key)))
-            yield URL(
-                key=url_key,
-                value=url_value,
-            )
+        for key, value in self.r.iter_urls(self.key.domain, self.cursor.key.id):
+            yield URL(key=key, value=value)
+
+    def all_failed_urls(self, batch_size=100):
+        failed_url_ids = self.r.sscan_iter(failed_url_ids_key(self.key.domain))
+
+        while True:
+            url_ids = [
+                self.codec.decode_id(u) for u in islice(failed_url_ids, batch_size)
+            ]
+            if not url_ids:
+                return
+
+            yield from self.fetch_urls(url_ids)
 
     def append_urls(self, urls: list[URL]):
         assert not self.disabled
@@ -303,13 +348,37 @@ class Provisioner:
 
         filtered_urls = filter_urls_by_domain(urls)
 
+        # urls the filter has seen are taken to exist without asking redis,
+        # so a false positive drops a new url. urls that exist but were
+        # missing from the filter, e.g. from before it, are added to it
         def filter_unique_urls(urls: list[URL]):
+            urls = [u for u in urls if u.key.id not in self.known_urls]
+
+            # links taken as known by the filter are remembered too, which
+            # does not change what gets appended
+            if self.url_filter:
+                seen_ids = {u.key.id for u in urls if u.key.id in self.url_filter}
+                self.known_urls.add(seen_ids)
+                urls = [u for u in urls if u.key.id not in seen_ids]
+
+            if not urls:
+                return []
+
             pipe = self.r.pipeline()
             for url in urls:
-                pipe.get(str(url.key))
+                pipe.exists(self.codec.key(url.key))
 
             results = pipe.execute()
             unique_urls = [u for u, r in zip(urls, results) if not r]
+
+            known_ids = [u.key.id for u, r in zip(urls, results) if r]
+            self.known_urls.add(known_ids)
+
+            if self.url_filter and known_ids:
+                pipe = self.r.pipeline()
+                self.url_filter.add(known_ids, pipe)
+                pipe.execute()
+
             return unique_urls
 
         unique_urls = filter_unique_urls(filtered_urls)
@@ -331,40 +400,85 @@ class Provisioner:
         unique_urls[-1].value.next = self.cursor.value.next
         self.cursor.value.next = unique_urls[0].key.id
 
-        pipe.set(str(self.cursor.key), self.cursor.value.to_json())
+        pipe.set(self.codec.key(self.cursor.key), self.codec.encode(self.cursor.value))
 
         for url in unique_urls:
-            pipe.set(str(url.key), url.value.to_json())
+            pipe.set(self.codec.key(url.key), self.codec.encode(url.value))
+
+        pipe.sadd(
+            url_ids_key(self.key.domain),
+            *[self.codec.encode_id(u.key.id) for u in unique_urls],
+        )
+
+        if self.url_filter:
+            self.url_filter.add([u.key.id for u in unique_urls], pipe)
+
+        # new urls are due right away, after the ones that were already due
+        now = timestamp()
+        pipe.zadd(
+            frontier_key(self.key.domain),
+            {self.codec.encode_id(u.key.id): now for u in unique_urls},
+        )
 
         pipe.execute()
 
+        self.known_urls.add(u.key.id for u in unique_urls)
+
     def append_url(self, url: URL):
         return self.append_urls([url])
 
-    def append_pending_urls(self):
+    def append_pending_urls(
+        self, canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER
+    ) -> bool:
         pending_urls, pending_url_ids = fetch_pending_urls(self.key.domain, limit=100)
-        urls = [URL.from_string(u, self.key.domain) for u in pending_urls]
+        # pending variants of the same url are appended once
+        canonical_urls = dict.fromkeys(canonicalize(u) for u in pending_urls)
+        urls = [URL.from_string(u, self.key.domain) for u in canonical_urls]
 
-        if pending_urls:
-            self.append_urls(urls)
-            delete_pending_urls(pending_url_ids)
-        else:
-            self.disable()
-            raise ExitProvisioner("No more urls to scrape.")
+        if not pending_urls:
+            return False
+
+        self.append_urls(urls)
+        delete_pending_urls(pending_url_ids)
+
+        return True
+
+    def discard_stale_window(self, url: URL):
+        # another copy of a url that was just written is out of date
+        if any(u.key.id == url.key.id and u is not url for u in self.window):
+            self.window.clear()
 
     def set_scraped(self, url: URL):
         url.value.scraped_at = timestamp()
-        success = self.r.set(str(url.key), url.value.to_json())
+        self.discard_stale_window(url)
+
+        pipe = self.r.pipeline()
+        pipe.set(self.codec.key(url.key), self.codec.encode(url.value))
+        pipe.srem(failed_url_ids_key(url.key.domain), self.codec.encode_id(url.key.id))
+        pipe.zadd(
+            frontier_key(url.key.domain),
+            {self.codec.encode_id(url.key.id): next_due(url.value, timestamp())},
+        )
+
+        success, *_ = pipe.execute()
 
         assert success
 
     def fail_url(self, url: URL):
         url.value.failed_at = timestamp()
-        failed_url_key = FailedURLKey.from_url_key(url.key)
+        self.discard_stale_window(url)
 
         pipe = self.r.pipeline()
-        pipe.set(str(url.key), url.value.to_json())
-        pipe.set(str(failed_url_key), b"")
+        pipe.set(self.codec.key(url.key), self.codec.encode(url.value))
+        pipe.sadd(failed_url_ids_key(url.key.domain), self.codec.encode_id(url.key.id))
+        pipe.zadd(
+            frontier_key(url.key.domain),
+            {
+                self.codec.encode_id(url.key.id): url.value.failed_at
+                + round(FAILED_REVISIT_INTERVAL / timedelta(milliseconds=1))
+            },
+        )
 
-        results = pipe.execute()
-        assert all(results)
+        success, *_ = pipe.execute()
+
+        assert success
@@ -1,12 +1,104 @@
+from collections import Counter
+from dataclasses import replace
+from datetime import timedelta
+from functools import cached_property
 import os
 from urllib.parse import urlparse
 from dotenv import load_dotenv
 from redis import Redis
 from redis.client import Redis
+from redis.commands.core import Script
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
 from src.helpers.flask_error_handler import HTTPException
+from src.helpers.misc import timestamp
 from src.models.provisioner import ProvisionerKey, ProvisionerStatus, ProvisionerValue
 
-from src.models.url import URL, FailedURLKey, URLKey, URLValue
+from src.models.url import (
+    URL,
+    FailedURLKey,
+    URLKey,
+    URLValue,
+    failed_url_ids_key,
+    frontier_key,
+    url_ids_key,
+)
+from src.models.url_codec import URLCodec, url_codec_from_env
+from src.models.url_filter import URLFilter, url_filter_key, url_filter_params_key
+
+# sorted set of every provisioner key. off provisioners are scored by their
+# priority, or by when their next url is due if none were due when they were
+# released, on provisioners by the expiry of their lease (both millisecond
+# timestamps) and disabled provisioners by +inf, so the claimable provisioners
+# are exactly the ones with a score lower than the current time
+PROVISIONER_INDEX = "provisioner_index"
+
+# hash of domain -> current provisioner key
+PROVISIONER_DOMAINS = "provisioner_domains"
+
+# renames the provisioner at KEYS[1] to KEYS[2], replacing its value with
+# ARGV[1] unless it is empty, rescores it in the index at KEYS[3] and points
+# the domain ARGV[3] to the new key in the hash at KEYS[4]
+MOVE_PROVISIONER_SCRIPT = """
+local value = redis.call("GET", KEYS[1])
+if not value then
+    return 0
+end
+
+if ARGV[1] ~= "" then
+    value = ARGV[1]
+end
+
+redis.call("DEL", KEYS[1])
+redis.call("SET", KEYS[2], value)
+redis.call("ZREM", KEYS[3], KEYS[1])
+redis.call("ZADD", KEYS[3], ARGV[2], KEYS[2])
+redis.call("HSET", KEYS[4], ARGV[3], KEYS[2])
+
+return 1
+"""
+
+# claims the provisioner at KEYS[3] if it is still in the index at KEYS[1]
+# and claimable at ARGV[1]. it is renamed to KEYS[4] with a lease expiring at
+# ARGV[2], and the domain ARGV[3] is pointed to it in the hash at KEYS[2]. an
+# index entry whose provisioner is gone is removed
+CLAIM_PROVISIONER_SCRIPT = """
+local score = redis.call("ZSCORE", KEYS[1], KEYS[3])
+if not score or tonumber(score) > tonumber(ARGV[1]) then
+    return nil
+end
+
+local value = redis.call("GET", KEYS[3])
+redis.call("ZREM", KEYS[1], KEYS[3])
+
+if not value then
+    return nil
+end
+
+redis.call("DEL", KEYS[3])
+redis.call("SET", KEYS[4], value)
+redis.call("ZADD", KEYS[1], ARGV[2], KEYS[4])
+redis.call("HSET", KEYS[2], ARGV[3], KEYS[4])
+
+return value
+"""
+
+
+def provisioner_score(
+    key: ProvisionerKey,
+    lease_expiry: int = None,
+    due_at: int = None,
+):
+    if key.status == ProvisionerStatus.disabled:
+        return "+inf"
+
+    if key.status == ProvisionerStatus.on:
+        assert lease_expiry is not None
+        return lease_expiry
+
+    if due_at is not None:
+        return due_at
+
+    return key.priority
 
 
 class RedisService(Redis):
@@ -21,22 +113,48 @@ class RedisService(Redis):
         service: RedisService = super().__enter__()
         return service
 
-    def insert_provisioner(self, root_url: str, priority=2, domain: str = None):
+    @property
+    def url_codec(self) -> URLCodec:
+        return url_codec_from_env()
+
+    # the lua scripts are registered once per service and then run by their
+    # sha, falling back to loading them when the server doesn't know it
+    @cached_property
+    def move_provisioner_script(self) -> Script:
+        return self.register_script(MOVE_PROVISIONER_SCRIPT)
+
+    @cached_property
+    def claim_provisioner_script(self) -> Script:
+        return self.register_script(CLAIM_PROVISIONER_SCRIPT)
+
+    # callers pass the canonicalizer of the domain, so the root url hashes to
+    # the same id as the links to it
+    def insert_provisioner(
+        self,
+        root_url: str,
+        priority=2,
+        domain: str = None,
+        canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER,
+    ):
         if not domain:
             domain = urlparse(root_url).netloc
 
             if domain != "127.0.0.1":
                 domain = ".".join(domain.split(".")[-2:])
 
-        existing = self.keys(f"provisioner:*:{domain}:*")
-        if existing:
+        if self.hexists(PROVISIONER_DOMAINS, domain):
             print(f"provisioner with domain '{domain}' already exists")
             return
 
         pipe = self.pipeline()
 
+        codec = self.url_codec
+
+        root_url = canonicalize(root_url)
         url = URL.from_string(root_url, domain)
-        pipe.set(str(url.key), url.value.to_json())
+        pipe.set(codec.key(url.key), codec.encode(url.value))
+        pipe.sadd(url_ids_key(domain), codec.encode_id(url.key.id))
+        pipe.zadd(frontier_key(domain), {codec.encode_id(url.key.id): 0})
 
         provisioner_key = ProvisionerKey(
             domain=domain,
@@ -47,6 +165,11 @@ class RedisService(Redis):
         provisioner_value = ProvisionerValue(cursor=url.key.id)
 
         pipe.set(str(provisioner_key), provisioner_value.to_json())
+        pipe.zadd(
+            PROVISIONER_INDEX,
+            {str(provisioner_key): provisioner_score(provisioner_key)},
+        )
+        pipe.hset(PROVISIONER_DOMAINS, domain, str(provisioner_key))
 
         pipe.execute()
 
@@ -56,74 +179,401 @@ class RedisService(Redis):
         for provisioner_key in self.scan_provisioner_keys():
             domain = provisioner_key.domain
 
-            for url_key_bytes in self.scan_url_keys(domain):
-                pipe.delete(str(url_key_bytes))
-
-            for url_key_bytes in self.scan_failed_url_keys(domain):
-                pipe.delete(str(url_key_bytes))
+            for url_key in self.scan_url_keys(domain):
+                pipe.delete(self.url_codec.key(url_key))
 
+            pipe.delete(url_ids_key(domain))
+            pipe.delete(failed_url_ids_key(domain))
+            pipe.delete(frontier_key(domain))
+            pipe.delete(url_filter_key(domain))
+            pipe.delete(url_filter_params_key(domain))
             pipe.delete(str(provisioner_key))
 
+        pipe.delete(PROVISIONER_INDEX)
+        pipe.delete(PROVISIONER_DOMAINS)
+
         pipe.execute()
 
     def scan_provisioner_keys(self):
-        for provisioner_key_bytes in self.scan_iter("provisioner:*"):
+        for provisioner_key_bytes in self.zrange(PROVISIONER_INDEX, 0, -1):
             provisioner_key = ProvisionerKey.from_string(provisioner_key_bytes.decode())
 
             yield provisioner_key
 
     def fetch_provisioner(self, domain: str) -> tuple[ProvisionerKey, ProvisionerValue]:
-        keys = self.keys(f"provisioner:*:{domain}:*")
-        if not keys:
+        key_bytes = self.hget(PROVISIONER_DOMAINS, domain)
+        if not key_bytes:
             raise HTTPException(f"provisioner with domain {domain} not found", 404)
 
-        key = ProvisionerKey.from_string(keys[0].decode())
+        key = ProvisionerKey.from_string(key_bytes.decode())
         value_str = self.get(str(key)).decode()
         value = ProvisionerValue.from_json(value_str)
 
         return key, value
 
     def fetch_url(self, domain: str, url_id: str):
+        codec = self.url_codec
+
         key = URLKey(domain=domain, id=url_id)
-        value_json = self.get(str(key))
+        raw_value = self.get(codec.key(key))
 
-        if value_json is None:
+        if raw_value is None:
             raise KeyError(f"URL with id {url_id} not found")
 
-        value: URLValue = URLValue.from_json(value_json)
+        value: URLValue = codec.decode(raw_value)
         return key, value
 
+    # walks the ring from the cursor, one node at a time since every node
+    # names the next
     def iter_urls(self, domain: str, cursor: str):
-        key, value = self.fetch_url(domain, cursor)
-        yield key, value
+        url_id = cursor
 
-        while value.next != cursor:
-            key, value = self.fetch_url(domain, value.next)
+        while True:
+            key, value = self.fetch_url(domain, url_id)
             yield key, value
 
-    def scan_failed_url_keys(self, domain: str):
-        for key in self.scan_iter(f"failed_url:{domain}:*"):
-            yield FailedURLKey.from_string(key.decode())
+            if value.next == cursor:
+                return
 
-    def scan_url_keys(self, domain: str):
-        for key in self.scan_iter(f"url:{domain}:*"):
-            yield URLKey.from_string(key.decode())
+            url_id = value.next
 
-    def update_provisioner_key(
+    def set_url(self, key: URLKey, value: URLValue, codec: URLCodec = None):
+        codec = codec or self.url_codec
+
+        pipe = self.pipeline()
+
+        pipe.set(codec.key(key), codec.encode(value))
+        pipe.sadd(url_ids_key(key.domain), codec.encode_id(key.id))
+        pipe.zadd(frontier_key(key.domain), {codec.encode_id(key.id): 0}, nx=True)
+
+        if value.failed_at and value.failed_at > (value.scraped_at or 0):
+            pipe.sadd(failed_url_ids_key(key.domain), codec.encode_id(key.id))
+
+        pipe.execute()
+
+    def scan_failed_url_keys(self, domain: str, codec: URLCodec = None):
+        codec = codec or self.url_codec
+
+        for raw_id in self.sscan_iter(failed_url_ids_key(domain)):
+            yield FailedURLKey(domain=domain, id=codec.decode_id(raw_id))
+
+    def scan_url_keys(self, domain: str, codec: URLCodec = None):
+        codec = codec or self.url_codec
+
+        for raw_id in self.sscan_iter(url_ids_key(domain)):
+            yield URLKey(domain=domain, id=codec.decode_id(raw_id))
+
+    def count_urls(self, domain: str) -> int:
+        return self.scard(url_ids_key(domain))
+
+    def count_failed_urls(self, domain: str) -> int:
+        return self.scard(failed_url_ids_key(domain))
+
+    def count_due_urls(self, domain: str) -> int:
+        return self.zcount(frontier_key(domain), "-inf", timestamp())
+
+    def next_due(self, domain: str) -> int | None:
+        first = self.zrange(frontier_key(domain), 0, 0, withscores=True)
+        if not first:
+            return None
+
+        _, score = first[0]
+        return round(score)
+
+    def reindex_urls(self, domain: str):
+        codec = self.url_codec
+        prefix = codec.key_prefix(domain)
+
+        pipe = self.pipeline()
+
+        pipe.delete(url_ids_key(domain))
+        pipe.delete(failed_url_ids_key(domain))
+
+        # urls missing from the frontier are due right away, the others keep
+        # their schedule
+        for key_bytes in self.scan_iter(prefix + b"*"):
+            pipe.sadd(url_ids_key(domain), key_bytes[len(prefix) :])
+            pipe.zadd(frontier_key(domain), {key_bytes[len(prefix) :]: 0}, nx=True)
+
+        for key_bytes in self.scan_iter(f"failed_url:{domain}:*"):
+            failed_url_key = FailedURLKey.from_string(key_bytes.decode())
+            pipe.sadd(failed_url_ids_key(domain), codec.encode_id(failed_url_key.id))
+            pipe.delete(str(failed_url_key))
+
+        pipe.execute()
+
+        self.rebuild_url_filter(domain)
+
+    def rebuild_url_filter(self, domain: str):
+        url_filter = URLFilter.from_env(domain)
+        url_filter.add([key.id for key in self.scan_url_keys(domain)])
+
+        pipe = self.pipeline()
+        url_filter.save(pipe)
+        pipe.execute()
+
+    # merges the urls of a domain that canonicalize to the same url into one,
+    # and relinks the ring in its current order. the merged url takes the
+    # crawl state of the copy that was scraped last and is due when the first
+    # copy was. workers must not be running, or their claims would write the
+    # old urls back. returns how many urls were merged away
+    def compact_urls(self, domain: str, canonicalize: URLCanonicalizer) -> int:
+        codec = self.url_codec
+        provisioner_key, provisioner_value = self.fetch_provisioner(domain)
+
+        urls = [*self.iter_urls(domain, provisioner_value.cursor)]
+        if not urls:
+            return 0
+
+        # links are canonicalized to the host of the page they are on, which
+        # for most of them is the host the domain is crawled on
+        hosts = Counter(urlparse(value.url).hostname for _, value in urls)
+        page_host, _ = hosts.most_common(1)[0]
+
+        pipe = self.pipeline()
+        for key, _ in urls:
+            pipe.zscore(frontier_key(domain), codec.encode_id(key.id))
+        due_at = {key.id: score for (key, _), score in zip(urls, pipe.execute())}
+
+        groups: dict[str, list[tuple[URLKey, URLValue]]] = {}
+        for key, value in urls:
+            canonical = canonicalize(value.url, page_host=page_host)
+            groups.setdefault(canonical, []).append((key, value))
+
+        merged: list[URL] = []
+        merged_ids: dict[str, str] = {}
+        merged_due_at: dict[str, float] = {}
+        for canonical, copies in groups.items():
+            _, latest = max(copies, key=lambda copy: copy[1].scraped_at or 0)
+            changed_at = [v.changed_at for _, v in copies if v.changed_at]
+
+            url = URL.from_string(canonical, domain)
+            url = URL(
+                key=url.key,
+                value=replace(
+                    latest,
+                    url=canonical,
+                    changed_at=max(changed_at, default=None),
+                ),
+            )
+            merged.append(url)
+
+            scores = [due_at[k.id] for k, _ in copies if due_at[k.id] is not None]
+            merged_due_at[url.key.id] = min(scores, default=0)
+            for key, _ in copies:
+                merged_ids[key.id] = url.key.id
+
+        # url ids are hashes of the urls, so nothing changes when every url
+        # is already canonical
+        if all(merged_ids[key.id] == key.id for key, _ in urls):
+            return 0
+
+        for url, next_url in zip(merged, merged[1:] + merged[:1]):
+            url.value.next = next_url.key.id
+
+        pipe = self.pipeline()
+
+        for key, _ in urls:
+            pipe.delete(codec.key(key))
+        pipe.delete(url_ids_key(domain))
+        pipe.delete(failed_url_ids_key(domain))
+        pipe.delete(frontier_key(domain))
+
+        for url in merged:
+            raw_id = codec.encode_id(url.key.id)
+            pipe.set(codec.key(url.key), codec.encode(url.value))
+            pipe.sadd(url_ids_key(domain), raw_id)
+            pipe.zadd(frontier_key(domain), {raw_id: merged_due_at[url.key.id]})
+
+            if url.value.failed_at and url.value.failed_at > (
+                url.value.scraped_at or 0
+            ):
+                pipe.sadd(failed_url_ids_key(domain), raw_id)
+
+        provisioner_value.cursor = merged_ids[provisioner_value.cursor]
+        pipe.set(str(provisioner_key), provisioner_value.to_json())
+
+        pipe.execute()
+
+        self.rebuild_url_filter(domain)
+
+        return len(urls) - len(merged)
+
+    def migrate_urls(
         self,
-        old_key: ProvisionerKey,
-        new_key: ProvisionerKey,
+        domain: str,
+        source: URLCodec,
+        target: URLCodec,
+        batch_size=1000,
+    ):
+        url_keys = [*self.scan_url_keys(domain, codec=source)]
+        failed_url_keys = [*self.scan_failed_url_keys(domain, codec=source)]
+        due_at = [
+            (source.decode_id(raw_id), score)
+            for raw_id, score in self.zscan_iter(frontier_key(domain))
+        ]
+
+        for i in range(0, len(url_keys), batch_size):
+            batch = url_keys[i : i + batch_size]
+            raw_values = self.mget([source.key(key) for key in batch])
+
+            pipe = self.pipeline()
+            for key, raw_value in zip(batch, raw_values):
+                if raw_value is None:
+                    continue
+
+                pipe.delete(source.key(key))
+                pipe.set(target.key(key), target.encode(source.decode(raw_value)))
+
+            pipe.execute()
+
+        pipe = self.pipeline()
+
+        pipe.delete(url_ids_key(domain))
+        pipe.delete(failed_url_ids_key(domain))
+        pipe.delete(frontier_key(domain))
+
+        for i in range(0, len(url_keys), batch_size):
+            batch = url_keys[i : i + batch_size]
+            pipe.sadd(url_ids_key(domain), *[target.encode_id(k.id) for k in batch])
+
+        for i in range(0, len(failed_url_keys), batch_size):
+            batch = failed_url_keys[i : i + batch_size]
+            pipe.sadd(
+                failed_url_ids_key(domain),
+                *[target.encode_id(k.id) for k in batch],
+            )
+
+        for i in range(0, len(due_at), batch_size):
+            batch = due_at[i : i + batch_size]
+            pipe.zadd(
+                frontier_key(domain),
+                {target.encode_id(url_id): score for url_id, score in batch},
+            )
+
+        pipe.execute()
+
+    def set_provisioner(
+        self,
+        key: ProvisionerKey,
         value: ProvisionerValue,
+        lease_expiry: int = None,
     ):
         pipe = self.pipeline()
 
-        pipe.set(str(new_key), value.to_json())
-        pipe.delete(str(old_key))
+        pipe.set(str(key), value.to_json())
+        pipe.zadd(PROVISIONER_INDEX, {str(key): provisioner_score(key, lease_expiry)})
+        pipe.hset(PROVISIONER_DOMAINS, key.domain, str(key))
+
+        pipe.execute()
+
+    def reindex_provisioners(self, timeout=timedelta(minutes=5)):
+        pipe = self.pipeline()
+
+        pipe.delete(PROVISIONER_INDEX)
+        pipe.delete(PROVISIONER_DOMAINS)
+
+        for key_bytes in self.scan_iter("provisioner:*"):
+            key = ProvisionerKey.from_string(key_bytes.decode())
+            value = ProvisionerValue.from_json(self.get(str(key)))
+
+            lease_expiry = None
+            if key.status == ProvisionerStatus.on:
+                last_scraped = value.last_scraped or 0
+                lease_expiry = last_scraped + round(timeout / timedelta(milliseconds=1))
+
+            pipe.zadd(
+                PROVISIONER_INDEX, {str(key): provisioner_score(key, lease_expiry)}
+            )
+            pipe.hset(PROVISIONER_DOMAINS, key.domain, str(key))
+
+        pipe.execute()
+
+    def move_provisioner(
+        self,
+        old_key: ProvisionerKey,
+        new_key: ProvisionerKey,
+        value: ProvisionerValue = None,
+        lease_expiry: int = None,
+        due_at: int = None,
+    ) -> bool:
+        moved = self.move_provisioner_script(
+            keys=[
+                str(old_key),
+                str(new_key),
+                PROVISIONER_INDEX,
+                PROVISIONER_DOMAINS,
+            ],
+            args=[
+                value.to_json() if value else "",
+                provisioner_score(new_key, lease_expiry, due_at),
+                new_key.domain,
+            ],
+        )
+
+        return moved == 1
 
-        _, del_count = pipe.execute()
+    # off provisioners are preferred over expired on provisioners, then lower
+    # priorities, then older leases
+    def claimable_provisioners(self, now: int) -> list[ProvisionerKey]:
+        candidates = [
+            (ProvisionerKey.from_string(raw_key.decode()), score)
+            for raw_key, score in self.zrangebyscore(
+                PROVISIONER_INDEX, "-inf", now, withscores=True
+            )
+        ]
+        candidates.sort(
+            key=lambda candidate: (
+                candidate[0].status != ProvisionerStatus.off,
+                candidate[0].priority,
+                candidate[1],
+            )
+        )
+
+        return [key for key, _ in candidates]
+
+    # claims the given provisioner, or the best claimable one. candidates that
+    # another worker claimed first, or that are gone, are skipped
+    def claim_provisioner(
+        self,
+        provisioner_id: str,
+        time_id: int,
+        lease_expiry: int,
+        key: ProvisionerKey = None,
+    ) -> tuple[ProvisionerKey, ProvisionerValue] | None:
+        now = timestamp()
+
+        for candidate in [key] if key else self.claimable_provisioners(now):
+            new_key = ProvisionerKey(
+                status=ProvisionerStatus.on,
+                domain=candidate.domain,
+                priority=candidate.priority,
+                provisioner_id=provisioner_id,
+                time_id=time_id,
+            )
 
-        if del_count == 0:
-            self.r.delete(str(new_key))
+            value_json = self.claim_provisioner_script(
+                keys=[
+                    PROVISIONER_INDEX,
+                    PROVISIONER_DOMAINS,
+                    str(candidate),
+                    str(new_key),
+                ],
+                args=[now, lease_expiry, candidate.domain],
+            )
+
+            if value_json:
+                return new_key, ProvisionerValue.from_json(value_json)
+
+        return None
+
+    def update_provisioner_key(
+        self,
+        old_key: ProvisionerKey,
+        new_key: ProvisionerKey,
+        value: ProvisionerValue,
+    ):
+        if not self.move_provisioner(old_key, new_key, value):
             raise ValueError(
                 "Could not modify key. Key was probably modified by another actor"
             )
@@ -145,3 +595,13 @@ class RedisService(Redis):
 
         new_key = old_key.with_status(ProvisionerStatus.off)
         self.update_provisioner_key(old_key, new_key, value)
+
+    # makes an off provisioner that is waiting for its next url to be due
+    # claimable right away, e.g. when pending urls were added for it
+    def wake_provisioner(self, domain: str):
+        key, _ = self.fetch_provisioner(domain)
+
+        if key.status != ProvisionerStatus.off:
+            return
+
+        self.zadd(PROVISIONER_INDEX, {str(key): provisioner_score(key)}, xx=True)
@@ -1,9 +1,17 @@
 from abc import ABC, abstractmethod
 
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
+from src.models.url import URLValue
+
 
 class URLHandler(ABC):
+    # how the urls the handler returns were canonicalized
+    canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER
+
+    # value is the stored state of the url, which handlers may update before
+    # it is written back when the url is marked as scraped
     @abstractmethod
-    def handle_url(self, url: str) -> list[str]:
+    def handle_url(self, url: str, value: URLValue = None) -> list[str]:
         raise NotImplementedError()
 
     @abstractmethod
@@ -1,41 +1,84 @@
 from abc import ABC, abstractmethod
+from collections import defaultdict
+from dataclasses import dataclass
+import json
+import re
+from threading import Lock, get_ident
+from time import perf_counter
 from typing import Iterable
 from urllib.parse import urlparse
-import requests
-from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
-
-from src.services.prisma_service import upsert_product
+import httpx
+from playwright.sync_api import (
+    BrowserContext,
+    Request,
+    Route,
+    TimeoutError as PlaywrightTimeoutError,
+    sync_playwright,
+)
+
+from src.services.prisma_service import (
+    PriceObservationBuffer,
+    product_cache,
+    upsert_products,
+)
 from src.services.finn_service import FinnURLHandler
 from src.services.url_handler import URLHandler
+from src.helpers.auto_scrape import Document
 from src.helpers.exceptions import NotAProductPage
-from src.helpers.import_tools import import_scraper
-
-
-def iter_urls(base_url: str, content):
-    soup = BeautifulSoup(content, "html.parser")
+from src.helpers.canonical_url import (
+    DEFAULT_CANONICALIZER,
+    URLCanonicalizer,
+    strip_www,
+)
+from src.helpers.import_tools import import_scraper_module
+from src.helpers.misc import hash_string, timestamp
+from src.helpers.revisit import record_visit
+from src.models.product import Product
+from src.models.url import URLValue
+
+
+# links on the same site as the page, canonicalized. links to the www or bare
+# host of the page are moved to the page's host
+def iter_urls(
+    base_url: str,
+    document: Document,
+    canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER,
+):
     domain = urlparse(base_url).netloc
     scheme = urlparse(base_url).scheme
+    host = urlparse(base_url).hostname
 
-    for a in soup.find_all("a"):
-        href = a.get("href")
+    for href in document.links:
         if not href:
             continue
         if href == "#":
             continue
 
         if "http" in href:
-            url_domain = urlparse(href).netloc
-            if url_domain == domain:
-                yield str(href)
+            url = str(href)
         else:
             url = f"{scheme}://{domain}{href}"
-            url_domain = urlparse(url).netloc
-            if url_domain == domain:
-                yield url
+
+        url = canonicalize(url, page_host=host)
+        url_domain = urlparse(url).netloc
+        if strip_www(url_domain) == strip_www(domain):
+            yield url
+
+
+def url_failed_last(value: URLValue) -> bool:
+    return bool(value.failed_at) and value.failed_at > (value.scraped_at or 0)
+
+
+# hash of what a page yields, so a recrawl can tell whether anything written
+# to the database would change
+def fingerprint_products(products: list[Product]) -> str:
+    return hash_string(json.dumps([p.to_dict() for p in products], sort_keys=True))
 
 
 class WebPageClient(ABC):
+    etag: str | None = None
+    last_modified: str | None = None
+
     @abstractmethod
     def setup(self):
         raise NotImplementedError()
@@ -48,69 +91,291 @@ class WebPageClient(ABC):
     def get(self, url: str):
         raise NotImplementedError()
 
+    # fetches the page unless the server says it is unchanged since the
+    # response the validators came from. returns whether it was fetched.
+    # clients without conditional requests always fetch
+    def get_if_modified(
+        self,
+        url: str,
+        etag: str = None,
+        last_modified: str = None,
+    ) -> bool:
+        self.get(url)
+        return True
+
     @abstractmethod
     def content(self) -> bytes:
         raise NotImplementedError()
 
     @abstractmethod
-    def find_links(self, domain: str) -> Iterable[str]:
+    def find_links(
+        self,
+        domain: str,
+        document: Document = None,
+        canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER,
+    ) -> Iterable[str]:
         raise NotImplementedError()
 
 
+@dataclass
+class RequestTiming:
+    connect: float = 0
+    tls: float = 0
+    ttfb: float = 0
+    body: float = 0
+    total: float = 0
+
+    def __str__(self) -> str:
+        return (
+            f"connect {self.connect * 1000:.0f}ms, tls {self.tls * 1000:.0f}ms, "
+            f"ttfb {self.ttfb * 1000:.0f}ms, body {self.body * 1000:.0f}ms, "
+            f"total {self.total * 1000:.0f}ms"
+        )
+
+
 class RequestClient(WebPageClient):
+    def __init__(self, pool_size=10, http2=False, timeout=30):
+        self.pool_size = pool_size
+        self.http2 = http2
+        self.timeout = timeout
+
     def setup(self):
         self._content = None
+        self.timing = None
+        self.client = httpx.Client(
+            http2=self.http2,
+            timeout=self.timeout,
+            follow_redirects=True,
+            limits=httpx.Limits(
+                max_connections=self.pool_size,
+                max_keepalive_connections=self.pool_size,
+            ),
+            headers={
+                "User-Agent": "PostmanRuntime/7.32.3",
+            },
+        )
 
     def teardown(self):
-        pass
+        self.client.close()
 
     def get(self, url):
-        response = requests.get(
+        self.get_if_modified(url)
+
+    def get_if_modified(
+        self,
+        url: str,
+        etag: str = None,
+        last_modified: str = None,
+    ) -> bool:
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        timing = RequestTiming()
+        started_at = {}
+
+        # httpcore reports the phases of every request, including redirects.
+        # dns lookups are part of connect_tcp
+        def trace(event_name: str, info: dict):
+            phase, event = event_name.split(".")[-2:]
+            if event == "started":
+                started_at[phase] = perf_counter()
+                return
+
+            if event != "complete" or phase not in started_at:
+                return
+
+            elapsed = perf_counter() - started_at[phase]
+            if phase == "connect_tcp":
+                timing.connect += elapsed
+            elif phase == "start_tls":
+                timing.tls += elapsed
+            elif phase == "receive_response_body":
+                timing.body += elapsed
+            elif phase == "receive_response_headers":
+                timing.ttfb += perf_counter() - started_at["send_request_headers"]
+
+        start = perf_counter()
+        response = self.client.get(
             url.replace("localhost", "127.0.0.1"),
-            allow_redirects=True,
-            headers={
-                "User-Agent": "PostmanRuntime/7.32.3",
-            },
+            headers=headers,
+            extensions={"trace": trace},
         )
+        timing.total = perf_counter() - start
+
+        self.timing = timing
+        print("request timing:", timing)
+
+        if response.status_code == 304:
+            self._content = None
+            return False
+
         self._content = response.content
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        return True
 
     def content(self) -> bytes:
         return self._content
 
-    def find_links(self, domain: str) -> Iterable[str]:
-        links = [*iter_urls(domain, self.content())]
+    def find_links(
+        self,
+        domain: str,
+        document: Document = None,
+        canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER,
+    ) -> Iterable[str]:
+        document = document or Document(self.content())
+        links = [*iter_urls(domain, document, canonicalize)]
         return list(dict.fromkeys(links))
 
 
+# resources the crawler never looks at. scripts are only loaded from the site
+# itself, since pages may need their own scripts to render
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+
+def site_of(url: str) -> str:
+    host = urlparse(url).hostname or ""
+    return host.removeprefix("www.")
+
+
+def is_same_site(url: str, site: str) -> bool:
+    host = urlparse(url).hostname or ""
+    return host == site or host.endswith(f".{site}")
+
+
+# one playwright driver and chromium shared by the playwright clients on a
+# thread, since the sync api can only be used from the thread that started it.
+# clients get a browser context each, and chromium is relaunched if it dies
+class BrowserPool:
+    pools: dict[int, "BrowserPool"] = {}
+    lock = Lock()
+
+    def __init__(self):
+        self.users = 0
+        self.playwright = None
+        self.browser = None
+
+    @classmethod
+    def acquire(cls) -> "BrowserPool":
+        with cls.lock:
+            pool = cls.pools.setdefault(get_ident(), BrowserPool())
+
+        pool.users += 1
+        return pool
+
+    def release(self):
+        self.users -= 1
+        if self.users > 0:
+            return
+
+        with BrowserPool.lock:
+            BrowserPool.pools.pop(get_ident(), None)
+
+        self.stop()
+
+    def new_context(self) -> BrowserContext:
+        if not self.playwright:
+            self.playwright = sync_playwright().start()
+
+        if not self.browser or not self.browser.is_connected():
+            self.browser = self.playwright.chromium.launch(headless=True)
+
+        return self.browser.new_context()
+
+    def stop(self):
+        try:
+            if self.browser and self.browser.is_connected():
+                self.browser.close()
+        except Exception as e:
+            print("Error closing browser:", e)
+
+        if self.playwright:
+            self.playwright.stop()
+
+        self.browser = None
+        self.playwright = None
+
+
 class PlayWrightClient(WebPageClient):
+    # wait_for is a selector the page is given wait_for_timeout ms to attach
+    # after the DOM is loaded, for content that is rendered by scripts
+    def __init__(self, wait_until="domcontentloaded", wait_for_timeout=5000):
+        self.wait_until = wait_until
+        self.wait_for: str | None = None
+        self.wait_for_timeout = wait_for_timeout
+        self.site = None
+
     def setup(self):
-        self.playwright = sync_playwright().start()
-        self.browser = self.playwright.chromium.launch(headless=True)
-        self.context = self.browser.new_context()
-        self.page = self.context.new_page()
+        self.browsers = BrowserPool.acquire()
+        self.new_page()
 
     def teardown(self):
-        self.playwright.stop()
+        try:
+            self.context.close()
+        except Exception as e:
+            print("Error closing browser context:", e)
+
+        self.browsers.release()
+
+    def new_page(self):
+        self.context = self.browsers.new_context()
+        self.context.route("**/*", self.route)
+        self.page = self.context.new_page()
+
+    def route(self, route: Route, request: Request):
+        if request.resource_type in BLOCKED_RESOURCE_TYPES:
+            return route.abort()
+
+        if request.resource_type == "script" and self.site:
+            if not is_same_site(request.url, self.site):
+                return route.abort()
 
+        return route.continue_()
+
+    def goto(self, url: str):
+        self.page.goto(url, wait_until=self.wait_until)
+
+        if self.wait_for:
+            try:
+                self.page.wait_for_selector(
+                    self.wait_for,
+                    state="attached",
+                    timeout=self.wait_for_timeout,
+                )
+            except PlaywrightTimeoutError:
+                pass
+
+        self.context.clear_cookies()
+
+    # a failing page only costs its own context, the browser is kept
     def get(self, url: str):
+        self.site = site_of(url)
+
         try:
-            self.page.goto(url)
-            self.context.clear_cookies()
+            self.goto(url)
         except Exception as e:
             print("WARNING", type(e), type(e).__name__, e)
             try:
-                self.teardown()
+                self.context.close()
             except Exception as e:
-                print("Error running teardown:", e)
-            self.setup()
-            self.page.goto(url)
-            self.context.clear_cookies()
+                print("Error closing browser context:", e)
+            self.new_page()
+            self.goto(url)
 
     def content(self):
         return self.page.content()
 
-    def find_links(self, domain: str):
-        links = [*iter_urls(domain, self.content())]
+    def find_links(
+        self,
+        domain: str,
+        document: Document = None,
+        canonicalize: URLCanonicalizer = DEFAULT_CANONICALIZER,
+    ):
+        document = document or Document(self.content())
+        links = [*iter_urls(domain, document, canonicalize)]
         return list(dict.fromkeys(links))
 
 
@@ -130,33 +395,258 @@ class ClientTester:
         return self.client.content()
 
 
-class ProductURLHandler(URLHandler):
-    def __init__(self, domain: str) -> list[str]:
-        clients = {
-            "power.no": PlayWrightClient,
-        }
+JSONLD_SELECTOR = 'script[type="application/ld+json"]'
+
+
+# keeps clients set up between provisioner claims, so a long running worker
+# only launches its browser once. a client is only handed out again on the
+# thread that set it up, since playwright clients are bound to that thread
+class ClientPool:
+    def __init__(self):
+        self.idle: dict[tuple[type, int], list[WebPageClient]] = defaultdict(list)
+        self.lock = Lock()
+
+    def acquire(self, client_type: type[WebPageClient]) -> WebPageClient:
+        with self.lock:
+            idle = self.idle[(client_type, get_ident())]
+            if idle:
+                return idle.pop()
+
+        client = client_type()
+        client.setup()
+        return client
+
+    def release(self, client: WebPageClient):
+        with self.lock:
+            self.idle[(type(client), get_ident())].append(client)
+
+    # tears down the idle clients that were set up on the calling thread
+    def close(self):
+        with self.lock:
+            keys = [key for key in self.idle if key[1] == get_ident()]
+            clients = [client for key in keys for client in self.idle.pop(key)]
+
+        for client in clients:
+            client.teardown()
+
+
+# domains whose pages may need a browser to render. plain http is tried first
+# and the browser is only used when the page as served comes up short
+BROWSER_DOMAINS = {"power.no"}
+
+
+# urls with the same depth and the same shape of the last path segment are
+# assumed to be the same kind of page, e.g. /a/b/p-1139441/ and /c/d/p-42/
+def url_pattern(url: str) -> str:
+    segments = [s for s in urlparse(url).path.split("/") if s]
+    last = segments[-1] if segments else ""
+    shape = re.sub(r"[^\W\d_]+", "*", re.sub(r"\d+", "#", last))
+    return f"{len(segments)}:{shape}"
+
+
+# what scraping a page gave. error is what the scraper raised, which is
+# NotAProductPage for pages without products
+@dataclass
+class PageYield:
+    products: list[Product]
+    links: list[str]
+    error: Exception | None = None
+
+
+# whether the rendered page gives more products, or clearly more links, than
+# the page as served
+def finds_more(rendered: PageYield, served: PageYield) -> bool:
+    if len(rendered.products) != len(served.products):
+        return len(rendered.products) > len(served.products)
+
+    return len(rendered.links) > len(served.links) * 1.2 + 5
+
+
+# learns per url pattern whether escalating to the browser finds more than
+# plain http. patterns where the last probes escalations all found more are
+# fetched with the browser right away, and compared against http every
+# reprobe_interval urls. patterns where they never did are only escalated
+# when http finds nothing at all, and every reprobe_interval urls
+class FetchStrategies:
+    def __init__(self, probes=3, reprobe_interval=100, min_links=10):
+        self.probes = probes
+        self.reprobe_interval = reprobe_interval
+        self.min_links = min_links
+        self.results: dict[str, list[bool]] = defaultdict(list)
+        self.seen: dict[str, int] = defaultdict(int)
+
+    def learned(self, pattern: str) -> bool | None:
+        results = self.results[pattern][-self.probes :]
+        if len(results) < self.probes:
+            return None
+
+        if all(results):
+            return True
+
+        if not any(results):
+            return False
+
+        return None
 
-        self.client = clients.get(domain, RequestClient)()
-        self.scrape = import_scraper(domain)
+    def reprobes(self, pattern: str) -> bool:
+        return self.seen[pattern] % self.reprobe_interval == 0
+
+    # "browser" fetches with the browser only, "probe" fetches both ways and
+    # compares, and "http" fetches with http and escalates when it is short
+    def get(self, pattern: str) -> str:
+        self.seen[pattern] += 1
+
+        if self.learned(pattern):
+            return "probe" if self.reprobes(pattern) else "browser"
+
+        return "http"
+
+    def escalates(self, pattern: str, served: PageYield) -> bool:
+        if served.products and len(served.links) >= self.min_links:
+            return False
+
+        if self.learned(pattern) is False:
+            return not served.links or self.reprobes(pattern)
+
+        return True
+
+    def record(self, pattern: str, needs_browser: bool):
+        print(f"url pattern {pattern} needs browser: {needs_browser}")
+        self.results[pattern].append(needs_browser)
+
+
+fetch_strategies: dict[str, FetchStrategies] = defaultdict(FetchStrategies)
+
+
+class ProductURLHandler(URLHandler):
+    def __init__(self, domain: str, client_pool: ClientPool = None) -> list[str]:
+        self.client_pool = client_pool
+        self.client: RequestClient = None
+        self.browser_client: PlayWrightClient = None
+        self.use_browser = domain in BROWSER_DOMAINS
+        self.strategies = fetch_strategies[domain]
+        scraper = import_scraper_module(domain)
+        self.scrape = scraper.scrape
+        self.features = scraper.features
+        self.canonicalize = scraper.canonicalize
+        self.prices = PriceObservationBuffer()
         self.domain = domain
 
-    def handle_url(self, url: str):
-        self.client.get(url)
+    def handle_url(self, url: str, value: URLValue = None):
+        pattern = url_pattern(url)
+        strategy = self.strategies.get(pattern) if self.use_browser else "http"
 
-        try:
-            products = [*self.scrape(url, self.client.content())]
-            for product in products:
-                upsert_product(product)
-        except NotAProductPage:
+        if strategy == "browser":
+            page = self.read_page(url, self.fetch_with_browser(url))
+            etag, last_modified = None, None
+        else:
+            # validators are only sent when the last crawl of the url
+            # succeeded, so a failed scrape is retried even if the page did
+            # not change
+            if value and value.scraped_at and not url_failed_last(value):
+                modified = self.client.get_if_modified(
+                    url,
+                    etag=value.etag,
+                    last_modified=value.last_modified,
+                )
+            else:
+                modified = self.client.get_if_modified(url)
+
+            # the links found on the page the last time are already in the ring
+            if not modified:
+                print("not modified since last crawl")
+                record_visit(value, changed=False, now=timestamp())
+                return []
+
+            document = Document(self.client.content(), features=self.features)
+            page = self.read_page(url, document)
+            etag, last_modified = self.client.etag, self.client.last_modified
+
+            if strategy == "probe" or (
+                self.use_browser and self.strategies.escalates(pattern, page)
+            ):
+                rendered = self.read_page(url, self.fetch_with_browser(url))
+
+                needs_browser = finds_more(rendered, page)
+                self.strategies.record(pattern, needs_browser)
+
+                if needs_browser:
+                    page = rendered
+                    etag, last_modified = None, None
+
+        if isinstance(page.error, NotAProductPage):
             print("WARNING: NotAProductPage")
+        elif page.error:
+            raise page.error
+        else:
+            self.prices.add(page.products, observed_at=timestamp())
+
+            # the products are written before the fingerprint is stored, so a
+            # failed upsert fails the url and the page is upserted again on
+            # the next visit. they are not batched across pages, since the url
+            # is written back to redis, fingerprint included, as soon as it is
+            # handled
+            fingerprint = fingerprint_products(page.products)
+            changed = not value or value.fingerprint != fingerprint
+            if changed:
+                upsert_products(page.products)
+            else:
+                print("unchanged since last crawl, skipping upsert")
+
+            if value:
+                record_visit(value, changed, now=timestamp())
+                value.fingerprint = fingerprint
+
+        if value:
+            value.etag = etag
+            value.last_modified = last_modified
+
+        return page.links
+
+    def read_page(self, url: str, document: Document) -> PageYield:
+        links = self.client.find_links(url, document, self.canonicalize)
+        try:
+            return PageYield([*self.scrape(url, document)], links)
+        except Exception as e:
+            return PageYield([], links, error=e)
+
+    def fetch_with_browser(self, url: str) -> Document:
+        if not self.browser_client:
+            self.browser_client = self.acquire_client(PlayWrightClient)
+            self.browser_client.wait_for = (
+                JSONLD_SELECTOR if "jsonld" in self.features else None
+            )
+
+        self.browser_client.get(url)
+        return Document(self.browser_client.content(), features=self.features)
+
+    def acquire_client(self, client_type: type[WebPageClient]):
+        if self.client_pool:
+            return self.client_pool.acquire(client_type)
 
-        return self.client.find_links(url)
+        client = client_type()
+        client.setup()
+        return client
+
+    def release_client(self, client: WebPageClient):
+        if self.client_pool:
+            self.client_pool.release(client)
+        else:
+            client.teardown()
 
     def setup(self):
-        self.client.setup()
+        self.client = self.acquire_client(RequestClient)
 
     def teardown(self):
-        self.client.teardown()
+        try:
+            self.prices.flush()
+        finally:
+            print(f"product cache: {product_cache}")
+
+            self.release_client(self.client)
+            if self.browser_client:
+                self.release_client(self.browser_client)
+                self.browser_client = None
 
 
 class WebPageService:
@@ -164,11 +654,11 @@ class WebPageService:
         self.url_handler = url_handler
 
     @classmethod
-    def from_domain(cls, domain: str):
+    def from_domain(cls, domain: str, client_pool: ClientPool = None):
         if domain == "finn.no":
             return WebPageService(FinnURLHandler())
 
-        return WebPageService(ProductURLHandler(domain))
+        return WebPageService(ProductURLHandler(domain, client_pool))
 
     def __enter__(self):
         self.url_handler.setup()
@@ -177,5 +667,9 @@ class WebPageService:
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.url_handler.teardown()
 
-    def handle_url(self, url: str) -> list[str]:
-        return self.url_handler.handle_url(url)
+    def handle_url(self, url: str, value: URLValue = None) -> list[str]:
+        return self.url_handler.handle_url(url, value)
+
+    @property
+    def canonicalize(self) -> URLCanonicalizer:
+        return self.url_handler.canonicalize
@@ -122,7 +122,7 @@ class TestAPI(unittest.TestCase):
             self.assertRaises(ExitProvisioner, run)
 
             key, _ = r.fetch_provisioner("finn.no")
-            self.assertEqual(key.status, ProvisionerStatus.disabled)
+            self.assertEqual(key.status, ProvisionerStatus.off)
 
             # TODO: use dependency injection to mock the finn service
 
@@ -174,7 +174,7 @@ class TestAPI(unittest.TestCase):
             self.assertEqual(type(exception), ExitProvisioner)
 
             key, _ = r.fetch_provisioner("finn.no")
-            self.assertEqual(key.status, ProvisionerStatus.disabled)
+            self.assertEqual(key.status, ProvisionerStatus.off)
 
             for product_id in self.product_ids:
                 product = get_product_by_id(product_id)
@@ -0,0 +1,65 @@
+# python -m unittest tests.test_auto_scrape
+
+import unittest
+
+from src.helpers.auto_scrape import Document
+from tests.test_website.html import product_html
+from tests.test_website.product import test_products
+
+PAGES = [
+    product_html(["p/1", "https://www.test.com/p/2"], test_products[0]),
+    """
+    <html>
+    <head>
+        <meta property="og:title" content="Smartphone &amp; case">
+        <meta name="description" content="Two &quot;tags&quot;">
+        <meta name="description" content="with one name">
+        <meta itemprop="price" content="599.99">
+        <meta charset="UTF-8">
+        <script type="application/ld+json">
+            [{"@type": "Product", "name": "Æ &amp; Ø"}, {"@type": "BreadcrumbList"}]
+        </script>
+        <script type="application/ld+json">{"@type": "Product", "name": "b"}</script>
+        <script>var a = "<a href='/not-a-link'>";</script>
+    </head>
+    <body>
+        <a href="/a?b=1&amp;c=2">a</a>
+        <a href="">empty</a>
+        <a name="anchor">no href</a>
+        <A HREF="https://www.test.com/upper">upper</A>
+        <a href="#">top</a>
+    </body>
+    </html>
+    """,
+]
+
+
+class TestDocument(unittest.TestCase):
+    def test_streaming_matches_dom(self):
+        for page in PAGES:
+            for content in [page, page.encode()]:
+                streamed = Document(content, features={"jsonld", "metatags", "links"})
+                parsed = Document(content, features={"dom"})
+
+                self.assertEqual(streamed.jsonld, parsed.jsonld)
+                self.assertEqual(streamed.metatags, parsed.metatags)
+                self.assertEqual(streamed.links, parsed.links)
+
+                # the tree is only built when a scraper asks for it
+                self.assertNotIn("soup", streamed.__dict__)
+
+    def test_extracted(self):
+        document = Document(PAGES[1])
+
+        self.assertEqual(len(document.jsonld["Product"]), 2)
+        self.assertEqual(document.jsonld["Product"][0]["name"], "Æ & Ø")
+        self.assertEqual(document.metatags["og:title"], ["Smartphone & case"])
+        self.assertEqual(
+            document.metatags["description"], ['Two "tags"', "with one name"]
+        )
+        self.assertIn("/a?b=1&c=2", document.links)
+        self.assertNotIn("/not-a-link", document.links)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+# python -m unittest tests.test_canonical_url
+
+import unittest
+
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
+
+
+class TestURLCanonicalizer(unittest.TestCase):
+    def test_query(self):
+        self.assertEqual(
+            DEFAULT_CANONICALIZER("https://www.test.com/a/?utm_source=x&b=2&a=1#top"),
+            "https://www.test.com/a?a=1&b=2",
+        )
+
+        canonicalize = URLCanonicalizer(allowed_params=frozenset({"page"}))
+        self.assertEqual(
+            canonicalize("https://www.test.com/k?page=2&sort=price"),
+            "https://www.test.com/k?page=2",
+        )
+
+    def test_query_quoting(self):
+        # sorted by the decoded parameters, but written as they were found
+        self.assertEqual(
+            DEFAULT_CANONICALIZER("https://www.test.com/s?q=a%20b&f=c%2Fd&e"),
+            "https://www.test.com/s?e&f=c%2Fd&q=a%20b",
+        )
+        self.assertEqual(
+            DEFAULT_CANONICALIZER("https://www.test.com/s?q=a+b&utm_%73ource=x"),
+            "https://www.test.com/s?q=a+b",
+        )
+        self.assertEqual(
+            DEFAULT_CANONICALIZER("https://www.test.com/s?b=%C3%A6&a=%2B&&"),
+            "https://www.test.com/s?a=%2B&b=%C3%A6",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
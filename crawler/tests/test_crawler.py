@@ -8,7 +8,7 @@ from src.services.redis_service import RedisService
 from tests.test_website.graph import build_endpoints_graph
 from src.models.url import URL
 from src.services.web_page_service import WebPageService
-from src.services.provisioner import Provisioner
+from src.services.provisioner import ExitProvisioner, Provisioner
 
 os.environ[
     "POSTGRESQL_URL"
@@ -22,20 +22,22 @@ class TestCrawler(unittest.TestCase):
         # TODO use worker.py
         with Provisioner() as p:
             with WebPageService.from_domain(self.domain) as web:
-                for url in p.iter_urls():
-                    print(url)
+                try:
+                    for url in p.iter_urls():
+                        print(url)
 
-                    if url.visited:
-                        break
+                        new_urls_str = web.handle_url(url.value.url)
+                        # sleep(10)
 
-                    new_urls_str = web.handle_url(url.value.url)
-                    # sleep(10)
+                        new_urls = [
+                            URL.from_string(u, self.domain) for u in new_urls_str
+                        ]
 
-                    new_urls = [URL.from_string(u, self.domain) for u in new_urls_str]
+                        p.append_urls(new_urls)
 
-                    p.append_urls(new_urls)
-
-                    p.set_scraped(url)
+                        p.set_scraped(url)
+                except ExitProvisioner:
+                    pass
 
                 all_urls = [*p.all_urls()]
                 website_graph = build_endpoints_graph()
@@ -14,12 +14,18 @@ from src.services.prisma_service import (
     IdentifierChangeError,
     clear_tables,
     count_products,
+    fetch_latest_prices,
+    fetch_price_history,
     find_existing_product,
     get_ambiguous_products,
     get_product_by_id,
+    insert_price_observations,
     insert_product,
+    product_cache,
     upsert_product,
+    upsert_products,
 )
+from src.models.price_observation import PriceObservation
 from src.models.product import Product, Retailer
 
 
@@ -228,5 +234,87 @@ class TestDatabase(unittest.TestCase):
         self.assertEqual(root, self.product_0)
         self.assertListEqual(children, [product0_to_upsert, product1_to_upsert])
 
+    def test_upsert_products(self):
+        products = [
+            build_product(gtin="700", mpn="M-3", retailer="eplehuset", sku="p-0"),
+            build_product(gtin="702", mpn="M-1", retailer="tings", sku="p-0"),
+            build_product(gtin="800", mpn="MP-0", retailer="elkjop", sku="p-1"),
+            build_product(gtin="800", mpn="MP-0", retailer="power", sku="p-1"),
+        ]
+
+        upserted_ids = upsert_products(products)
+
+        self.assertEqual(upserted_ids[0], self.id_0)
+        self.assertEqual(upserted_ids[2], upserted_ids[3])
+        self.assertEqual(count_products(), 5)
+
+        found_product = get_product_by_id(self.id_0)
+        self.assertListEqual(found_product.mpns, ["M-1", "M-3"])
+
+        root, children = get_ambiguous_products(upserted_ids[1])
+        self.assertEqual(root.id, self.id_0)
+        self.assertListEqual([c.id for c in children], [upserted_ids[1]])
+
+        found_product = get_product_by_id(upserted_ids[2])
+        self.assertListEqual(
+            [r.name for r in found_product.retailers],
+            ["elkjop", "power"],
+        )
+
+        with self.assertRaises(IdentifierChangeError):
+            upsert_products(
+                [
+                    build_product(gtin="900", retailer="komplett", sku="p-9"),
+                    build_product(gtin="702", retailer="elkjop", sku="p-0"),
+                ]
+            )
+
+        self.assertEqual(count_products(), 5)
+
+    def test_product_cache(self):
+        product = build_product(gtin="800", mpn="MP-0", retailer="elkjop", sku="p-1")
+
+        hits, misses = product_cache.hits, product_cache.misses
+
+        product_id = upsert_product(product)
+        self.assertEqual(upsert_product(product), product_id)
+        self.assertEqual(upsert_products([product]), [product_id])
+
+        self.assertEqual(product_cache.hits - hits, 2)
+        self.assertEqual(product_cache.misses - misses, 1)
+
+        changed = build_product(gtin="801", mpn="MP-0", retailer="elkjop", sku="p-1")
+        with self.assertRaises(IdentifierChangeError):
+            upsert_product(changed)
+
+        self.assertEqual(count_products(), 4)
+
+    def test_price_observations(self):
+        def observe(sku: str, price: float, observed_at: int):
+            return PriceObservation(
+                retailer="elkjop",
+                sku=sku,
+                price=price,
+                observed_at=observed_at,
+            )
+
+        insert_price_observations(
+            [
+                observe("p-0", 399.99, 1),
+                observe("p-0", 349.99, 3),
+                observe("p-1", 99, 1),
+            ]
+        )
+        insert_price_observations([observe("p-0", 379.99, 2)])
+
+        latest = fetch_latest_prices("elkjop")
+        self.assertListEqual(
+            sorted(latest),
+            [observe("p-0", 349.99, 3), observe("p-1", 99, 1)],
+        )
+
+        history = fetch_price_history("elkjop", "p-0")
+        self.assertListEqual([o.observed_at for o in history], [3, 2, 1])
+
     def tearDown(self) -> None:
         clear_tables()
@@ -9,16 +9,34 @@ os.environ[
 
 os.environ["REDIS_URL"] = "redis://localhost:6379"
 
+from src.models.finn_ad import FinnAd
+from src.helpers.revisit import MIN_PRODUCT_REVISIT_INTERVAL, revisit_interval
 from src.models.product import Product, Retailer
+from src.models.url import URLValue
 from src.services.finn_service import FinnURLHandler
 from src.services.web_page_service import WebPageService
 from src.services.prisma_service import (
     clear_tables,
     fetch_finn_ads,
+    get_product_by_id,
+    reconcile_finn_ads,
     upsert_product,
 )
 
 
+def build_ad(product_id: int, id: int, price: float, title="ad"):
+    return FinnAd(
+        id=id,
+        lat=59.9,
+        lng=10.7,
+        price=price,
+        timestamp=1700000000000,
+        title=title,
+        product_id=product_id,
+        image=None,
+    )
+
+
 class TestDatabase(unittest.TestCase):
     def test_upsert_finn_ads(self):
         with WebPageService(FinnURLHandler()) as finn:
@@ -31,6 +49,158 @@ class TestDatabase(unittest.TestCase):
     def test_unique_finn_ads(self):
         pass
 
+    def test_reconcile_finn_ads(self):
+        counts = reconcile_finn_ads(
+            self.product_id,
+            [
+                build_ad(self.product_id, 1, 100),
+                build_ad(self.product_id, 2, 200),
+                build_ad(self.product_id, 3, 300),
+            ],
+        )
+        self.assertEqual(counts, (3, 0, 0))
+
+        counts = reconcile_finn_ads(
+            self.product_id,
+            [
+                build_ad(self.product_id, 1, 100),
+                build_ad(self.product_id, 2, 150, title="sold soon"),
+                build_ad(self.product_id, 4, 400),
+            ],
+        )
+        self.assertEqual(counts, (1, 1, 1))
+
+        finn_ads = sorted(fetch_finn_ads(self.product_id))
+        self.assertListEqual(
+            finn_ads,
+            [
+                build_ad(self.product_id, 1, 100),
+                build_ad(self.product_id, 2, 150, title="sold soon"),
+                build_ad(self.product_id, 4, 400),
+            ],
+        )
+
+    def test_reconcile_truncated_finn_ads(self):
+        reconcile_finn_ads(
+            self.product_id, [build_ad(self.product_id, i, 100) for i in range(1, 5)]
+        )
+
+        # ads 3 and 4 may be on pages past the cap
+        counts = reconcile_finn_ads(
+            self.product_id,
+            [build_ad(self.product_id, 1, 100), build_ad(self.product_id, 2, 150)],
+            complete=False,
+        )
+        self.assertEqual(counts, (0, 1, 0))
+
+        finn_ads = sorted(fetch_finn_ads(self.product_id))
+        self.assertListEqual(
+            finn_ads,
+            [
+                build_ad(self.product_id, 1, 100),
+                build_ad(self.product_id, 2, 150),
+                build_ad(self.product_id, 3, 100),
+                build_ad(self.product_id, 4, 100),
+            ],
+        )
+
+    # an ad stored under another product is skipped, and is not new on every
+    # search of this one
+    def test_reconcile_ads_of_other_products(self):
+        other_id = upsert_product(
+            Product(
+                finn_query="Garmin Forerunner 255",
+                name="GARMIN FORERUNNER 255",
+                description="",
+                image="",
+                mpns=["010-02641-10"],
+                gtins=["753759278649"],
+                retailers=[],
+            )
+        )
+        reconcile_finn_ads(other_id, [build_ad(other_id, 1, 100)])
+
+        for _ in range(2):
+            counts = reconcile_finn_ads(
+                self.product_id,
+                [build_ad(self.product_id, 1, 100), build_ad(self.product_id, 2, 200)],
+            )
+        self.assertEqual(counts, (0, 0, 0))
+        self.assertListEqual(
+            fetch_finn_ads(self.product_id), [build_ad(self.product_id, 2, 200)]
+        )
+
+    def test_finn_search_complete(self):
+        def search_page(ids: list[int], match_count: int):
+            return {
+                "docs": [{"id": id, "trade_type": "Gis bort"} for id in ids],
+                "metadata": {"result_size": {"match_count": match_count}},
+            }
+
+        def search(pages: dict[int, dict], max_pages=20):
+            handler = FinnURLHandler(max_pages=max_pages)
+            handler.fetch_search_page = lambda query, page: pages[page]
+
+            with WebPageService(handler):
+                _, complete = handler.fetch_finn_ads(get_product_by_id(self.product_id))
+
+            return complete
+
+        pages = {
+            1: search_page([1, 2], 5),
+            2: search_page([3, 4], 5),
+            3: search_page([5], 5),
+        }
+        self.assertTrue(search(pages))
+        self.assertFalse(search(pages, max_pages=2))
+
+        pages[2] = search_page([], 5)
+        self.assertFalse(search(pages))
+
+        self.assertTrue(search({1: search_page([], 0)}))
+
+    def test_finn_search_records_changes(self):
+        def raw_ad(id: int, price: int):
+            return {
+                "type": "bap",
+                "id": str(id),
+                "main_search_key": "SEARCH_ID_BAP_COMMON",
+                "heading": "ad",
+                "location": "Oslo",
+                "flags": [],
+                "timestamp": 1700000000000,
+                "coordinates": {"lat": 59.9, "lon": 10.7},
+                "ad_type": 67,
+                "labels": [],
+                "extras": [],
+                "price": {"amount": price, "currency_code": "NOK"},
+                "distance": 0,
+                "trade_type": "Til salgs",
+                "image_urls": [],
+                "ad_id": id,
+            }
+
+        docs = [raw_ad(1, 100), raw_ad(2, 200)]
+        handler = FinnURLHandler()
+        handler.fetch_search_page = lambda query, page: {
+            "docs": docs,
+            "metadata": {"result_size": {"match_count": len(docs)}},
+        }
+
+        value = URLValue(url=str(self.product_id), next=str(self.product_id))
+        with WebPageService(handler) as finn:
+            finn.handle_url(str(self.product_id), value)
+            self.assertIsNotNone(value.changed_at)
+            self.assertEqual(value.unchanged_visits, 0)
+
+            finn.handle_url(str(self.product_id), value)
+            self.assertEqual(value.unchanged_visits, 1)
+            self.assertEqual(revisit_interval(value), MIN_PRODUCT_REVISIT_INTERVAL * 2)
+
+            docs[1] = raw_ad(2, 150)
+            finn.handle_url(str(self.product_id), value)
+            self.assertEqual(value.unchanged_visits, 0)
+
     def setUp(self) -> None:
         clear_tables()
 
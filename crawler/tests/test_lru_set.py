@@ -0,0 +1,49 @@
+# python -m unittest tests.test_lru_set
+
+import unittest
+
+from src.helpers.lru_set import LRUSet
+
+
+class TestLRUSet(unittest.TestCase):
+    def test_eviction(self):
+        items = LRUSet(max_size=3)
+        items.add(["a", "b", "c", "d"])
+
+        self.assertEqual(len(items), 3)
+        self.assertNotIn("a", items)
+        self.assertTrue(all(item in items for item in ["b", "c", "d"]))
+
+    def test_recency(self):
+        items = LRUSet(max_size=3)
+        items.add(["a", "b", "c"])
+
+        # a lookup makes an item the most recently used
+        self.assertIn("a", items)
+        items.add(["d"])
+        self.assertNotIn("b", items)
+
+        # and so does adding it again
+        items.add(["c"])
+        items.add(["e"])
+        self.assertNotIn("a", items)
+        self.assertListEqual(list(items.items), ["d", "c", "e"])
+
+    def test_missing_lookup(self):
+        items = LRUSet(max_size=2)
+        items.add(["a", "b"])
+
+        self.assertNotIn("c", items)
+        self.assertListEqual(list(items.items), ["a", "b"])
+
+    def test_clear(self):
+        items = LRUSet(max_size=2)
+        items.add(iter(["a", "b"]))
+        items.clear()
+
+        self.assertEqual(len(items), 0)
+        self.assertNotIn("a", items)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+# python -m unittest tests.test_product_cache
+
+from datetime import timedelta
+import unittest
+
+from src.helpers.product_cache import ProductCache
+from src.models.product import Product, Retailer
+
+
+def build_product(id=1, gtin="800", mpn="MP-0", sku="p-1") -> Product:
+    return Product(
+        id=id,
+        name="product",
+        description="",
+        image="",
+        gtins=[gtin],
+        mpns=[mpn],
+        retailers=[Retailer(name="elkjop", price=100, sku=sku, url="", category="")],
+    )
+
+
+class TestProductCache(unittest.TestCase):
+    def test_hits_and_misses(self):
+        cache = ProductCache()
+
+        self.assertIsNone(cache.lookup("elkjop", "p-1", gtin="800", mpn="MP-0"))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+        product = build_product()
+        cache.put(product)
+
+        self.assertEqual(cache.lookup("elkjop", "p-1", gtin="800", mpn="MP-0"), product)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        # a product with a new gtin has to be updated, so it is not a hit
+        self.assertIsNone(cache.lookup("elkjop", "p-1", gtin="801", mpn="MP-0"))
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+        self.assertEqual(str(cache), "hits=1 misses=2 size=3")
+
+    def test_expiry(self):
+        cache = ProductCache(ttl=timedelta(seconds=-1))
+        cache.put(build_product())
+
+        self.assertIsNone(cache.lookup("elkjop", "p-1", gtin="800", mpn="MP-0"))
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_eviction(self):
+        cache = ProductCache(max_size=3)
+        cache.put(build_product(id=1, gtin="800", mpn="MP-0", sku="p-1"))
+        cache.put(build_product(id=2, gtin="801", mpn="MP-1", sku="p-2"))
+
+        self.assertIsNone(cache.lookup("elkjop", "p-1", gtin="800", mpn="MP-0"))
+        self.assertIsNotNone(cache.lookup("elkjop", "p-2", gtin="801", mpn="MP-1"))
+
+
+if __name__ == "__main__":
+    unittest.main()
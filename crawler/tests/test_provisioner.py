@@ -12,15 +12,18 @@ os.environ[
 
 os.environ["REDIS_URL"] = "redis://localhost:6379"
 
-from scripts.worker import run
+from scripts.worker import concurrent_handler, run
+from src.helpers.canonical_url import DEFAULT_CANONICALIZER, URLCanonicalizer
+from src.helpers.misc import hash_string, timestamp
+from src.models.provisioner import ProvisionerStatus
 from src.services.prisma_service import (
     clear_tables,
     count_pending_urls,
     insert_pending_urls,
 )
-from src.services.redis_service import RedisService
+from src.services.redis_service import PROVISIONER_INDEX, RedisService
 from src.services.web_page_service import URLHandler, WebPageService
-from src.models.url import URL
+from src.models.url import URL, URLValue, frontier_key
 from src.services.provisioner import (
     ExitProvisioner,
     Provisioner,
@@ -29,7 +32,7 @@ from src.services.provisioner import (
 
 
 class TestURLHandler(URLHandler):
-    def handle_url(self, url: str) -> list[str]:
+    def handle_url(self, url: str, value: URLValue = None) -> list[str]:
         if url == "https://www.test.com":
             return [
                 "https://www.test.com/p/0",
@@ -60,7 +63,7 @@ class TestURLHandler(URLHandler):
 
 
 class InfiniteURLHandler(URLHandler):
-    def handle_url(self, url: str) -> list[str]:
+    def handle_url(self, url: str, value: URLValue = None) -> list[str]:
         sleep(0.1)
         if url == "https://www.test.com":
             return [
@@ -126,12 +129,9 @@ class TestProvisioner(unittest.TestCase):
                 for url in p.iter_urls():
                     print(url)
 
+                    self.assertNotIn(url.value.url, visited_urls)
                     visited_urls[url.value.url] = True
 
-                    if url.visited:
-                        p.append_pending_urls()
-                        continue
-
                     p.set_scraped(url)
 
         except ExitProvisioner as e:
@@ -140,6 +140,33 @@ class TestProvisioner(unittest.TestCase):
         self.assertEqual(count_pending_urls(self.domain), 0)
         self.assertEqual(len(visited_urls.keys()), 5)
 
+    def test_canonical_pending_urls(self):
+        insert_pending_urls(
+            self.domain,
+            [
+                "https://test.com/q/0?utm_source=test",
+                "https://www.test.com/q/0#reviews",
+                "https://www.test.com/q/1/",
+            ],
+        )
+
+        visited_urls = []
+
+        with self.assertRaises(ExitProvisioner):
+            with Provisioner() as p:
+                for url in p.iter_urls(URLCanonicalizer(host="www.test.com")):
+                    visited_urls.append(url.value.url)
+                    p.set_scraped(url)
+
+        self.assertListEqual(
+            sorted(visited_urls),
+            [
+                "https://www.test.com",
+                "https://www.test.com/q/0",
+                "https://www.test.com/q/1",
+            ],
+        )
+
     def test_fail_urls(self):
         with Provisioner() as p:
             p.append_url(
@@ -165,27 +192,126 @@ class TestProvisioner(unittest.TestCase):
                 [u.value.url for u in p.all_failed_urls()],
             )
 
-    def test_append_urls(self):
+    def crawl(self, prefetch=20):
         urls = []
-        with Provisioner() as p:
-            with WebPageService(TestURLHandler()) as web:
-                for url in p.iter_urls():
-                    print(url)
+        try:
+            with Provisioner(prefetch=prefetch) as p:
+                with WebPageService(TestURLHandler()) as web:
+                    for url in p.iter_urls():
+                        print(url)
+
+                        urls.append(url.value.url)
+
+                        new_urls_str = web.handle_url(url.value.url)
+                        new_urls = [
+                            URL.from_string(u, p.key.domain) for u in new_urls_str
+                        ]
+
+                        p.append_urls(new_urls)
+
+                        p.set_scraped(url)
+        except ExitProvisioner as e:
+            print(f"exit provisioner: {e.reason}")
+
+        return urls
+
+    def test_append_urls(self):
+        urls = self.crawl()
+
+        # urls found on the same page are due at the same time
+        self.assertEqual(urls[0], "https://www.test.com")
+        self.assertListEqual(
+            sorted(urls[1:4]),
+            [
+                "https://www.test.com/p/0",
+                "https://www.test.com/p/1",
+                "https://www.test.com/p/2",
+            ],
+        )
+        self.assertListEqual(
+            sorted(urls),
+            [
+                "https://www.test.com",
+                "https://www.test.com/p/0",
+                "https://www.test.com/p/1",
+                "https://www.test.com/p/1/0",
+                "https://www.test.com/p/2",
+                "https://www.test.com/p/2/0",
+                "https://www.test.com/p/2/1",
+            ],
+        )
+
+    def test_prefetch(self):
+        unbatched = self.crawl(prefetch=1)
+
+        self.tearDown()
+        self.setUp()
 
-                    if url.visited:
-                        break
+        batched = self.crawl(prefetch=3)
+
+        self.assertEqual(sorted(unbatched), sorted(batched))
+
+    def test_revisit(self):
+        self.crawl()
+
+        with RedisService.from_env_url() as r:
+            self.assertEqual(r.count_due_urls(self.domain), 0)
 
-                    urls.append(url.value.url)
+            key, _ = r.fetch_provisioner(self.domain)
+            self.assertEqual(key.status, ProvisionerStatus.off)
 
-                    new_urls_str = web.handle_url(url.value.url)
-                    new_urls = [URL.from_string(u, p.key.domain) for u in new_urls_str]
+            # nothing is due, so the provisioner waits for its next url
+            self.assertIsNone(r.claim_provisioner("test", 0, timestamp()))
 
-                    p.append_urls(new_urls)
+            r.wake_provisioner(self.domain)
+            self.assertIsNotNone(r.claim_provisioner("test", 0, timestamp()))
 
+    def test_stale_index_entry(self):
+        with RedisService.from_env_url() as r:
+            # ranked before the provisioner of the test domain, but gone
+            r.zadd(PROVISIONER_INDEX, {"provisioner:off:gone.com:0": 0})
+
+            key, _ = r.claim_provisioner("test", 0, timestamp())
+            self.assertEqual(key.domain, self.domain)
+            self.assertIsNone(r.zscore(PROVISIONER_INDEX, "provisioner:off:gone.com:0"))
+
+    def test_missing_frontier_urls(self):
+        visited_urls = []
+
+        with self.assertRaises(ExitProvisioner):
+            with Provisioner(prefetch=2) as p:
+                # due before the root url, but their values are gone
+                p.r.zadd(
+                    frontier_key(self.domain),
+                    {
+                        p.codec.encode_id(hash_string(f"https://www.test.com/{i}")): -1
+                        for i in range(5)
+                    },
+                )
+
+                for url in p.iter_urls():
+                    visited_urls.append(url.value.url)
                     p.set_scraped(url)
 
+        self.assertListEqual(visited_urls, ["https://www.test.com"])
+
+        with RedisService.from_env_url() as r:
+            self.assertEqual(r.zcard(frontier_key(self.domain)), 1)
+
+    def test_concurrent_handler(self):
+        self.assertRaises(
+            ExitProvisioner,
+            run,
+            concurrent_handler,
+            services=[WebPageService(TestURLHandler()) for _ in range(3)],
+        )
+
+        with RedisService.from_env_url() as r:
+            _, value = r.fetch_provisioner(self.domain)
+            urls = [url for _, url in r.iter_urls(self.domain, value.cursor)]
+
         self.assertListEqual(
-            urls,
+            sorted(url.url for url in urls),
             [
                 "https://www.test.com",
                 "https://www.test.com/p/0",
@@ -196,6 +322,39 @@ class TestProvisioner(unittest.TestCase):
                 "https://www.test.com/p/2/1",
             ],
         )
+        self.assertTrue(all(url.scraped_at for url in urls))
+
+    def test_compact_urls(self):
+        with Provisioner() as p:
+            p.append_urls(
+                [
+                    URL.from_string(u, p.key.domain)
+                    for u in [
+                        "https://www.test.com/p/0",
+                        "https://www.test.com/p/0/",
+                        "https://test.com/p/0?utm_source=test",
+                        "https://www.test.com/p/1#reviews",
+                    ]
+                ]
+            )
+
+        with RedisService.from_env_url() as r:
+            merged = r.compact_urls(self.domain, DEFAULT_CANONICALIZER)
+            self.assertEqual(merged, 2)
+
+            _, value = r.fetch_provisioner(self.domain)
+            urls = [url for _, url in r.iter_urls(self.domain, value.cursor)]
+
+            self.assertListEqual(
+                sorted(url.url for url in urls),
+                [
+                    "https://www.test.com",
+                    "https://www.test.com/p/0",
+                    "https://www.test.com/p/1",
+                ],
+            )
+            self.assertEqual(r.count_urls(self.domain), 3)
+            self.assertEqual(r.compact_urls(self.domain, DEFAULT_CANONICALIZER), 0)
 
     def setUp(self) -> None:
         clear_tables()
@@ -0,0 +1,75 @@
+# python -m unittest tests.test_url_codec
+
+import json
+import unittest
+
+from src.helpers.misc import hash_string
+from src.models.url import URLValue
+from src.models.url_codec import JSONURLCodec, PackedURLCodec
+
+NEXT_ID = hash_string("https://www.test.com/next")
+
+VALUES = [
+    URLValue(url="https://www.test.com", next=NEXT_ID),
+    URLValue(
+        url="https://www.test.com/p/æøå?q=1",
+        next=NEXT_ID,
+        scraped_at=1700000000000,
+        failed_at=1690000000000,
+        fingerprint=hash_string("products"),
+        etag='W/"abc"',
+        last_modified="Tue, 14 Nov 2023 22:13:20 GMT",
+        changed_at=1700000000000,
+        unchanged_visits=3,
+    ),
+]
+
+
+class TestURLCodec(unittest.TestCase):
+    def test_ids(self):
+        for codec in [JSONURLCodec(), PackedURLCodec()]:
+            self.assertEqual(codec.decode_id(codec.encode_id(NEXT_ID)), NEXT_ID)
+
+        self.assertEqual(len(PackedURLCodec().encode_id(NEXT_ID)), 16)
+
+    def test_round_trip(self):
+        json_codec, packed_codec = JSONURLCodec(), PackedURLCodec()
+
+        for value in VALUES:
+            self.assertEqual(json_codec.decode(json_codec.encode(value)), value)
+            self.assertEqual(packed_codec.decode(packed_codec.encode(value)), value)
+
+            # what migrate-urls does in either direction
+            packed = packed_codec.encode(json_codec.decode(json_codec.encode(value)))
+            self.assertEqual(
+                json_codec.decode(json_codec.encode(packed_codec.decode(packed))), value
+            )
+
+    def test_next_offset(self):
+        codec = PackedURLCodec()
+        raw = codec.encode(VALUES[0])
+
+        self.assertEqual(raw[0], codec.version)
+        self.assertEqual(raw[1:17].hex(), NEXT_ID)
+
+    # values written before the later fields were added decode with their
+    # defaults
+    def test_older_values(self):
+        codec = PackedURLCodec()
+        header = codec.header.pack(codec.version, bytes.fromhex(NEXT_ID))
+        payload = ["https://www.test.com", 1700000000000, None]
+
+        value = codec.decode(header + json.dumps(payload).encode())
+        self.assertEqual(
+            value,
+            URLValue(
+                url="https://www.test.com", next=NEXT_ID, scraped_at=1700000000000
+            ),
+        )
+
+        raw = json.dumps({"url": "https://www.test.com", "next": NEXT_ID}).encode()
+        self.assertEqual(JSONURLCodec().decode(raw), VALUES[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+# python -m unittest tests.test_url_filter
+
+import unittest
+import os
+
+os.environ["REDIS_URL"] = "redis://localhost:6379"
+
+from src.helpers.misc import hash_string
+from src.models.url_filter import URLFilter, url_filter_key, url_filter_params_key
+from src.services.redis_service import RedisService
+
+DOMAIN = "www.test.com"
+
+
+def url_ids(count: int, start=0) -> list[str]:
+    return [hash_string(f"https://{DOMAIN}/{i}") for i in range(start, start + count)]
+
+
+class TestURLFilter(unittest.TestCase):
+    def test_positions(self):
+        url_filter = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+        url_id = url_ids(1)[0]
+
+        positions = url_filter.positions(url_id)
+        self.assertEqual(len(positions), url_filter.hashes)
+        self.assertTrue(all(0 <= p < url_filter.size for p in positions))
+        self.assertEqual(positions, url_filter.positions(url_id))
+        self.assertNotEqual(positions, url_filter.positions(url_ids(1, start=1)[0]))
+
+    def test_contains(self):
+        url_filter = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+        added, missing = url_ids(1000), url_ids(1000, start=1000)
+
+        self.assertFalse(any(url_id in url_filter for url_id in added))
+
+        url_filter.add(added)
+        self.assertTrue(all(url_id in url_filter for url_id in added))
+
+        false_positives = sum(url_id in url_filter for url_id in missing)
+        self.assertLess(false_positives, 50)
+
+    def test_redis_bit_order(self):
+        url_filter = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+        [url_id] = url_ids(1)
+
+        with RedisService.from_env_url() as r:
+            url_filter.load(r)
+
+            pipe = r.pipeline()
+            url_filter.add([url_id], pipe)
+            pipe.execute()
+
+            for position in url_filter.positions(url_id):
+                self.assertEqual(r.getbit(url_filter.key, position), 1)
+
+            # redis only grows the bitmap up to the last bit that was set
+            raw = r.get(url_filter.key)
+            self.assertEqual(raw, bytes(url_filter.bits[: len(raw)]))
+            self.assertFalse(any(url_filter.bits[len(raw) :]))
+
+            # a bit set by redis reads as set in memory
+            [other_id] = url_ids(1, start=1)
+            for position in url_filter.positions(other_id):
+                r.setbit(url_filter.key, position, 1)
+
+            loaded = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+            loaded.load(r)
+            self.assertIn(url_id, loaded)
+            self.assertIn(other_id, loaded)
+
+    def test_changed_parameters(self):
+        url_filter = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+        url_filter.add(url_ids(100))
+
+        with RedisService.from_env_url() as r:
+            url_filter.save(r)
+
+            resized = URLFilter(DOMAIN, capacity=2000, error_rate=0.01)
+            resized.load(r)
+            self.assertFalse(any(resized.bits))
+
+            # the old bits are dropped rather than overwritten with zeros
+            self.assertFalse(r.exists(url_filter_key(DOMAIN)))
+            self.assertTrue(
+                r.get(url_filter_params_key(DOMAIN))
+                .decode()
+                .startswith(f"{resized.params}:")
+            )
+
+    def test_cached_bits(self):
+        url_filter = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+        [url_id, other_id] = url_ids(2)
+
+        with RedisService.from_env_url() as r:
+            url_filter.load(r)
+
+            pipe = r.pipeline()
+            url_filter.add([url_id], pipe)
+            pipe.execute()
+
+            # the bits are not read again while the filter keeps its stamp
+            for position in url_filter.positions(other_id):
+                r.setbit(url_filter.key, position, 1)
+
+            url_filter.load(r)
+            self.assertIn(url_id, url_filter)
+            self.assertNotIn(other_id, url_filter)
+
+            # but are once it was rebuilt
+            rebuilt = URLFilter(DOMAIN, capacity=1000, error_rate=0.01)
+            rebuilt.add([other_id])
+            rebuilt.save(r)
+
+            url_filter.load(r)
+            self.assertNotIn(url_id, url_filter)
+            self.assertIn(other_id, url_filter)
+
+    def setUp(self) -> None:
+        with RedisService.from_env_url() as r:
+            r.delete(url_filter_key(DOMAIN), url_filter_params_key(DOMAIN))
+
+    def tearDown(self) -> None:
+        with RedisService.from_env_url() as r:
+            r.delete(url_filter_key(DOMAIN), url_filter_params_key(DOMAIN))
+
+
+if __name__ == "__main__":
+    unittest.main()